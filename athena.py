@@ -0,0 +1,975 @@
+import io
+import os
+import re
+import glob
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
+from PIL import Image, ImageDraw
+from encoders import ImageEncoder, PNGStreamWriter, RenderedImage
+from layout import ShopLayout
+from publishqueue import PublishQueue
+from publishers import ImageArchive, TwitterPublisher, WebhookPublisher, FilesystemPublisher, S3Publisher
+from pipeline import Pipeline, Stage
+from metrics import timed, timings, registry, hash_changes, card_lookups, rotation_publish_seconds
+from utilty import ConfgFile, APITracker, ImageUtility, get_date
+
+log = logging.getLogger(__name__)
+
+
+class Athena:
+    config: ConfgFile
+    tracker: APITracker
+    image_utility: ImageUtility
+    encoders: dict
+    variants: list
+    previous_render: dict = None
+    archive: ImageArchive = None
+    card_cache: dict
+    header_cache: OrderedDict
+    header_lock: threading.Lock
+    icon_cache: OrderedDict
+    icon_lock: threading.Lock
+    placeholder: Image.Image = None
+    render_lock: threading.Lock
+    corrections: list
+    pipeline: Pipeline = None
+    publish_queue: PublishQueue
+    publishers: dict
+    warmed: threading.Event
+    first_render: bool = True
+
+    # Header strips kept, enough for a few languages and the previous day
+    HEADER_CACHE_SIZE = 8
+    HEADER_FONT_SIZE = 80
+    # Resized icons kept to stand in for icons which arrive late
+    ICON_CACHE_SIZE = 64
+    # Seconds the background re-render waits for late icons
+    CORRECTION_TIMEOUT = 300
+    # Seconds before the daily rotation at 00:00 UTC the render resources are warmed again
+    WARM_UP_LEAD = 120
+
+    def __init__(self, config: ConfgFile, tracker: APITracker = None) -> None:
+        self.config = config
+        self.tracker = tracker or APITracker(self.config.api_key, self.config.language, self.config.timeout)
+        if self.config.archive_enabled:
+            self.archive = ImageArchive(self.config.archive_directory, self.config.archive_retain)
+        self.image_utility = ImageUtility(self.config.prefetch_workers, self.config.timeout)
+        self.card_cache = {}
+        self.header_cache = OrderedDict()
+        self.header_lock = threading.Lock()
+        self.icon_cache = OrderedDict()
+        self.icon_lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self.corrections = []
+        self.warmed = threading.Event()
+        self.encoders = {name: ImageEncoder(settings) for name, settings in self.config.encoders.items()}
+        self.variants = [
+            {
+                "name": variant["name"],
+                "width": variant["width"],
+                "encoder": ImageEncoder(variant.get("encoder", self.config.encoders["file"])),
+            }
+            for variant in self.config.variants
+        ]
+
+        self.publish_queue = PublishQueue(self.config.publish_queue, self.config.publish_max_attempts, self.config.publish_retry_delay)
+        self.publishers = self.create_publishers()
+        for publisher in self.publishers.values():
+            # Authenticate at startup rather than when the Item Shop rotates
+            publisher.connect()
+            self.publish_queue.register(publisher.name, publisher.publish)
+        self.publish_queue.start()
+
+    def budget_encoders(self) -> list:
+        return [
+            encoder
+            for encoder in list(self.encoders.values()) + [variant["encoder"] for variant in self.variants]
+            if encoder.max_bytes is not None
+        ]
+
+    def budget_estimates(self) -> dict:
+        """Return the byte budget estimates of the encoders by their fingerprint, to be restored by the next run."""
+        return {encoder.fingerprint(): encoder.estimate() for encoder in self.budget_encoders() if encoder.estimate()}
+
+    def restore_estimates(self, estimates: dict) -> None:
+        """Start the byte budget encoders from the estimates of a previous run, ignoring those of changed settings."""
+        for encoder in self.budget_encoders():
+            estimate = estimates.get(encoder.fingerprint())
+            if isinstance(estimate, dict):
+                encoder.restore(estimate)
+
+    def start(self) -> None:
+        """Track the Item Shop forever, publishing every update."""
+        if self.config.metrics_enabled:
+            registry.serve(self.config.metrics_host, self.config.metrics_port)
+        self.check_for_initial_load()
+        self.track_updates()
+
+    def run_once(self, new_hash: str, data: dict) -> bool:
+        """
+        Generate and queue the images of the provided Item Shop, then wait for the publish
+        attempts which are due to finish. Failed publishes stay queued for the next run.
+
+        Return True if the images were generated and queued.
+        """
+        self.start_warm_up()
+        job = self.create_job(new_hash, data)
+        for stage in (self.parse_stage, self.prefetch_stage, self.render_stage, self.encode_stage):
+            job = stage(job)
+            if job is None:
+                return False
+
+        self.publish_stage(job)
+        self.publish_queue.drain()
+
+        # Wait for the corrected image of any late icons, and its publishes, before exiting
+        for correction in self.corrections:
+            correction.join()
+        self.publish_queue.drain()
+        return True
+
+    def create_publishers(self) -> dict:
+        """Return the enabled publishers by destination name."""
+        publishers = {}
+        support = self.config.support_a_creator
+
+        if self.config.twitter_enabled:
+            publishers["twitter"] = TwitterPublisher(
+                self.config.twitter_api_key,
+                self.config.twitter_api_secret,
+                self.config.twitter_access_token,
+                self.config.twitter_access_secret,
+                support,
+                self.config.twitter_chunk_size,
+                self.config.twitter_chunk_retries,
+                self.config.twitter_base_url,
+                self.config.twitter_upload_url,
+                self.config.twitter_timeout,
+            )
+
+        settings = self.config.publishers
+        if "webhook" in settings:
+            webhook = settings["webhook"]
+            publishers["webhook"] = WebhookPublisher(webhook["url"], webhook.get("username"), support, webhook.get("timeout", 30))
+        if "filesystem" in settings:
+            filesystem = settings["filesystem"]
+            publishers["filesystem"] = FilesystemPublisher(filesystem.get("directory", "published"), support, filesystem.get("timeout", 30))
+        if "s3" in settings:
+            if S3Publisher.available():
+                s3 = settings["s3"]
+                publishers["s3"] = S3Publisher(
+                    s3["bucket"],
+                    s3.get("prefix", ""),
+                    s3.get("endpointUrl"),
+                    s3.get("region"),
+                    s3.get("accessKey"),
+                    s3.get("secretKey"),
+                    support,
+                    s3.get("timeout", 30),
+                )
+            else:
+                log.warning("Athena => boto3 is not installed, not publishing to S3")
+        return publishers
+
+    def warm_up(self) -> None:
+        """Load the fonts and template images used by every render, reloading any which changed on disk."""
+        start = time.perf_counter()
+        images = ["assets/images/background.png", "assets/images/vbucks.png"] + sorted(glob.glob("assets/images/shopTemplates/*.png"))
+        # The text of cards shrinks from 40 and the section labels from the header size until it fits
+        sizes = list(range(25, 41)) + list(range(self.HEADER_FONT_SIZE - 20, self.HEADER_FONT_SIZE + 1))
+        fonts = [(size, "BurbankBigRegular-Black.ttf", "assets/fonts/") for size in sizes]
+
+        loaded = self.image_utility.warm([path for path in images if os.path.exists(path)], fonts)
+        self.warmed.set()
+        log.info(f"Athena => Warmed {loaded} render resources in => {(time.perf_counter() - start):.3f}")
+
+    def start_warm_up(self) -> None:
+        if self.config.warm_up:
+            threading.Thread(target=self.warm_up, name="warm-up", daemon=True).start()
+
+    def schedule_warm_up(self) -> None:
+        """Warm the render resources again shortly before every daily rotation."""
+        while True:
+            now = datetime.now(timezone.utc)
+            rotation = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+            delay = (rotation - now).total_seconds() - self.WARM_UP_LEAD
+            if delay > 0:
+                time.sleep(delay)
+                self.warm_up()
+            # Wait until after the rotation before scheduling the next one
+            time.sleep(max(self.WARM_UP_LEAD, 0) + 1)
+
+    def check_for_initial_load(self):
+        # Resources load in the background while the first poll waits on the network
+        self.start_warm_up()
+        if self.config.warm_up:
+            threading.Thread(target=self.schedule_warm_up, name="warm-up-schedule", daemon=True).start()
+
+        if not self.config.send_on_start:
+            is_loaded = self.tracker.initial_load()
+            # Just to make sure it's loaded
+            while not is_loaded:
+                log.error("Athena => Initial load faild, trying again in 5 seconds...")
+                time.sleep(5)
+                is_loaded = self.tracker.initial_load()
+            log.info("Athena => Initial load => Done.")
+
+    def track_updates(self):
+        log.info("Athena => Tracker started! Waiting for updates...")
+        self.pipeline = Pipeline([
+            Stage("fetch", self.fetch_stage, capacity=1),
+            Stage("parse", self.parse_stage, capacity=self.config.queue_size, failed=self.release_hash),
+            Stage("prefetch", self.prefetch_stage, capacity=self.config.queue_size, failed=self.release_hash),
+            Stage("render", self.render_stage, self.config.render_workers, self.config.queue_size, self.release_hash),
+            Stage("encode", self.encode_stage, self.config.encode_workers, self.config.queue_size, self.release_hash),
+            Stage("publish", self.publish_stage, self.config.publish_workers, self.config.queue_size),
+        ])
+        self.pipeline.start()
+
+        while True:
+            # Skip this poll if the previous one is still in progress or waiting to start
+            fetch = self.pipeline["fetch"]
+            if (fetch.stats()["busy"] > 0) or not fetch.put(time.time(), block=False):
+                log.warning("Athena => Previous poll still running, skipping this one")
+
+            time.sleep(15)
+
+    def fetch_stage(self, _) -> dict:
+        """Poll the Item Shop, returning a new job when its hash changed."""
+        new_hash, data = self.tracker.get_update()
+        if new_hash is None:
+            return None
+
+        log.info(f"Athena => Update detected => hash: {new_hash}")
+        hash_changes.inc()
+        # Claim the hash now so the next poll does not queue the same Item Shop again
+        self.tracker.update_hash(new_hash)
+        return self.create_job(new_hash, data)
+
+    def create_job(self, new_hash: str, data: dict) -> dict:
+        """Return the job of a detected Item Shop, whose icons must arrive within the render deadline."""
+        detected = time.time()
+        deadline = None
+        if self.config.render_deadline:
+            deadline = detected + self.config.render_deadline
+        rotated = self.rotation_time(data, detected)
+        return {"hash": new_hash, "data": data, "detected": detected, "rotated": rotated, "deadline": deadline}
+
+    @staticmethod
+    def rotation_time(data: dict, detected: float) -> float:
+        """Return the time.time() timestamp of the rotation dated in the provided Item Shop, detected if it has none."""
+        try:
+            rotated = datetime.fromisoformat(data["data"]["date"].replace("Z", "+00:00"))
+        except Exception:
+            return detected
+        if rotated.tzinfo is None:
+            rotated = rotated.replace(tzinfo=timezone.utc)
+        # A clock behind the API would otherwise report a negative delay
+        return min(rotated.timestamp(), detected)
+
+    def parse_stage(self, job: dict) -> dict:
+        job["date"] = get_date(self.config.language)
+        job["sections"] = self.parse_sections(job["data"].get("data", {}))
+        if len(job["sections"]) <= 0:
+            log.error("ImageGeneration => No entries in any of the Item Shop sections")
+            self.release_hash(job)
+            return None
+        return job
+
+    def prefetch_stage(self, job: dict) -> dict:
+        """Start downloading the icons of new cards so they can render as soon as their icon arrives."""
+        # Cards kept from the previous Item Shop are reused without their icon
+        uncached = [
+            (name, [item for item in entries if self.card_signature(item) not in self.card_cache])
+            for name, entries in job["sections"]
+        ]
+        job["icons"] = self.icon_urls(uncached)
+        self.image_utility.prefetch(job["icons"])
+        return job
+
+    def render_stage(self, job: dict) -> dict:
+        log.info(f"Athena => Generating image for {job['date']}")
+        start = time.time_ns()
+        warm = self.warmed.is_set()
+        late = []
+        with self.render_lock, timed("render"):
+            job["rendered"] = self.render_image(job["date"], job["sections"], job["deadline"], late)
+        job["degraded"] = len(late)
+
+        # The downloads of late icons are kept for the corrected image
+        late_icons = {url: self.image_utility.prefetched.get(url) for url in self.icon_urls([(None, late)])}
+        self.image_utility.discard([url for url in job["icons"] if url not in late_icons])
+        if job["rendered"] is None:
+            self.image_utility.discard(list(late_icons))
+            self.release_hash(job)
+            return None
+        log.info(f"Athena => Image Generated in => {((time.time_ns()-start)/1000000000)}")
+
+        if len(late) > 0:
+            log.warning(f"Athena => Publishing with {len(late)} degraded cards, their icons missed the render deadline")
+            if self.config.late_rerender:
+                correction = threading.Thread(
+                    target=self.correct_render,
+                    args=(job["hash"], job["date"], job["sections"], late_icons),
+                    name="correction",
+                    daemon=True,
+                )
+                correction.start()
+                self.corrections = [thread for thread in self.corrections if thread.is_alive()] + [correction]
+            else:
+                self.image_utility.discard(list(late_icons))
+        if self.first_render:
+            self.first_render = False
+            log.info(
+                f"Athena => First render since start was {'warm' if warm else 'cold'}, "
+                f"took => {((time.time_ns()-start)/1000000000):.3f}"
+            )
+        return job
+
+    def encode_stage(self, job: dict) -> dict:
+        job["images"] = self.encode_pages(job["rendered"])
+        # The canvases are no longer needed once encoded
+        del job["rendered"]
+        if job["images"] is None:
+            self.release_hash(job)
+            return None
+
+        for name, publisher in self.publishers.items():
+            publisher.prepare(self.destination_images(job["images"], name))
+        return job
+
+    def publish_stage(self, job: dict) -> None:
+        """Hand the images to the background publisher, which survives restarts and retries failures."""
+        for name in self.publishers:
+            log.info(f"Athena => Queueing image for {name}...")
+            self.publish_queue.enqueue(job["hash"], name, job["date"], self.destination_images(job["images"], name))
+
+        log.info(
+            f"Athena => Item Shop {job['hash']} done {(time.time() - job['detected']):.3f}s after detection "
+            f"with {job.get('degraded', 0)} degraded cards"
+        )
+        if self.pipeline is not None:
+            self.pipeline.log_stats()
+
+        # Summarize the rotation once the due publish attempts finished, retries are part of the next one
+        self.publish_queue.drain()
+        now = time.time()
+        published = now - job["detected"]
+        rotation_publish_seconds.observe(now - job["rotated"])
+        timings.flush(hash=job["hash"], degraded=job.get("degraded", 0), published=round(published, 3))
+        if self.pipeline is not None:
+            log.info("Athena => Waiting for new updates...")
+
+    def correct_render(self, shop_hash: str, date: str, sections: list, late_icons: dict) -> None:
+        """
+        Wait for the late icons of a published Item Shop, then render, save and archive it again,
+        and publish the corrected image to the destinations configured to be replaced.
+        """
+        futures = [future for future in late_icons.values() if future is not None]
+        start = time.perf_counter()
+        wait(futures, timeout=self.CORRECTION_TIMEOUT)
+
+        def replaced() -> bool:
+            # The correction must never overwrite or be published after a newer Item Shop
+            if self.tracker.last_hash != shop_hash:
+                log.info(f"Athena => Item Shop {shop_hash} was replaced, skipping its correction")
+                return True
+            return False
+
+        try:
+            remaining = []
+            with self.render_lock:
+                if replaced():
+                    return
+                rendered = self.render_image(date, sections, missing=remaining)
+            if rendered is None:
+                return
+
+            images = self.encode_pages(rendered, save=False)
+            if (images is None) or replaced():
+                return
+            self.save_images(images)
+            log.info(
+                f"Athena => Corrected Item Shop {shop_hash} {(time.perf_counter() - start):.3f}s after publishing, "
+                f"{len(remaining)} cards still degraded"
+            )
+
+            if replaced():
+                return
+            for name in self.config.late_replace:
+                if name in self.publishers:
+                    self.publish_queue.enqueue(f"{shop_hash}-corrected", name, date, self.destination_images(images, name))
+        except Exception as error:
+            log.error(f"Athena => Failed to correct Item Shop {shop_hash} => {error}")
+        finally:
+            self.image_utility.discard(list(late_icons))
+
+    @staticmethod
+    def destination_images(pages: list, destination: str) -> list:
+        """Return the image of every page encoded for destination, the `file` image if it has no encoder of its own."""
+        return [page.get(destination, page["file"]) for page in pages]
+
+    def release_hash(self, job) -> None:
+        """Forget the claimed hash of a failed job so the next poll retries it."""
+        if isinstance(job, dict) and (self.tracker.last_hash == job.get("hash")):
+            self.tracker.update_hash(None)
+
+    def generate_image(self, date: str, itemshop: dict, deadline: float = None) -> list:
+        """
+        Generate the Item Shop image using the provided Item Shop, split into the
+        configured number of pages which are rendered in parallel.
+
+        Return the encoded images of every page by destination and variant name,
+        None if generation failed.
+        """
+        try:
+            sections = self.parse_sections(itemshop)
+
+            if len(sections) <= 0:
+                log.error(f"ImageGeneration => No entries in any of the {len(itemshop)} Item Shop fields")
+                return None
+        except Exception as error:
+            log.critical(f"ImageGeneration => Failed to parse Item Shop sections, {error}")
+            return None
+
+        rendered = self.render_image(date, sections, deadline)
+        if rendered is None:
+            return None
+        return self.encode_pages(rendered)
+
+    def render_image(self, date: str, sections: list, deadline: float = None, missing: list = None) -> list:
+        """
+        Render the provided (name, entries) sections, split into the configured number
+        of pages which are rendered in parallel. Cards whose icon has not arrived by the
+        deadline, a time.time() timestamp, are rendered without it and their items are
+        appended to missing.
+
+        Return the (page, canvas) of every page, where a streamed page is already
+        encoded, None if rendering failed.
+        """
+        pages = [
+            [(sections[index][0], sections[index][1][start:end]) for index, start, end in page]
+            for page in ShopLayout.paginate([len(entries) for _, entries in sections], self.config.pages)
+        ]
+
+        if len(pages) == 1:
+            rendered = [(None, self.render_page(date, pages[0], deadline=deadline, missing=missing))]
+        else:
+            log.info(f"ImageGeneration => Rendering {len(pages)} pages")
+            with ThreadPoolExecutor(max_workers=len(pages)) as executor:
+                canvases = executor.map(lambda page: self.render_page(date, page[1], page[0], deadline, missing), enumerate(pages, 1))
+                rendered = list(zip(range(1, len(pages) + 1), canvases))
+
+        # Only keep the cards of the current Item Shop
+        current = {self.card_signature(item) for _, entries in sections for item in entries}
+        for signature in [signature for signature in self.card_cache if signature not in current]:
+            del self.card_cache[signature]
+
+        if None in [canvas for _, canvas in rendered]:
+            return None
+        return rendered
+
+    def encode_pages(self, rendered: list, save: bool = True) -> list:
+        """
+        Encode the (page, canvas) of every rendered page in parallel and save them,
+        unless save is False.
+
+        Return the encoded images of every page by destination and variant name,
+        None if encoding failed.
+        """
+        def encode(page: tuple) -> dict:
+            number, canvas = page
+            # Streamed pages are encoded while rendering
+            if isinstance(canvas, dict):
+                return canvas
+            return self.encode_outputs(canvas, number)
+
+        with ThreadPoolExecutor(max_workers=len(rendered)) as executor:
+            images = list(executor.map(encode, rendered))
+
+        if None in images:
+            return None
+        if save:
+            self.save_images(images)
+        return images
+
+    def render_page(self, date: str, sections: list, page: int = None, deadline: float = None, missing: list = None):
+        """
+        Render the image of the provided (name, entries) sections. Only a single page,
+        where page is None, keeps its canvas to repaint changed cards next time. Items
+        whose card is missing its icon are appended to missing.
+
+        Return the canvas, or the encoded images when streaming, None if rendering failed.
+        """
+        layout = ShopLayout.compute([len(entries) for _, entries in sections], self.config.aspect_ratio)
+
+        placements = [
+            (item, x, y)
+            for (_, entries), section in zip(sections, layout.sections)
+            for item, (x, y) in zip(entries, section.positions)
+        ]
+        labels = [(name, section.x, section.width) for (name, _), section in zip(sections, layout.sections)]
+        size = layout.size
+
+        if self.config.stream_output:
+            return self.stream_image(date, size, placements, labels, page, deadline, missing)
+
+        previous = self.previous_render
+        if (page is None) and (previous is not None) and (previous["size"] == size) and (previous["labels"] == labels) and (
+            [(x, y) for _, x, y in previous["placements"]] == [(x, y) for _, x, y in placements]
+        ):
+            # The layout geometry is unchanged, so only repaint what differs
+            shopImage = previous["image"]
+
+            if previous["date"] != date:
+                self.paint_background(shopImage, (0, 0, shopImage.width, ShopLayout.HEADER_HEIGHT))
+                self.draw_header(shopImage, date, labels)
+
+            # Cards previously rendered without their icon are repainted as well
+            changed = [
+                (item, x, y)
+                for (item, x, y), (old, _, _) in zip(placements, previous["placements"])
+                if (item != old) or ((x, y) in previous["degraded"])
+            ]
+            cards = [(item, self.cached_card(item, deadline), x, y) for item, x, y in changed]
+            with timed("compose"):
+                for _, card, x, y in cards:
+                    self.paint_background(shopImage, (x, y, x + ShopLayout.CARD_WIDTH, y + ShopLayout.CARD_HEIGHT))
+                    if card is not None:
+                        shopImage.paste(card, (x, y), card)
+
+            log.info(f"ImageGeneration => Layout unchanged, repainted {len(changed)} of {len(placements)} cards")
+        else:
+            cards = [(item, self.cached_card(item, deadline), x, y) for item, x, y in self.arrival_order(placements, deadline)]
+            cards = [(item, card, x, y) for item, card, x, y in cards if card is not None]
+
+            with timed("compose"):
+                shopImage = Image.new("RGB", size)
+                self.paint_background(shopImage)
+                self.draw_header(shopImage, date, labels)
+
+                for _, card, x, y in cards:
+                    shopImage.paste(card, (x, y), card)
+
+        # Unchanged cards were complete, as degraded ones are always repainted
+        late = [(item, x, y) for item, card, x, y in cards if (card is not None) and card.info.get("missingIcon")]
+        degraded = {(x, y) for _, x, y in late}
+        if missing is not None:
+            missing.extend(item for item, _, _ in late)
+        if len(degraded) > 0:
+            log.warning(f"ImageGeneration => {len(degraded)} of {len(placements)} cards are missing their icon")
+
+        if page is None:
+            self.previous_render = {
+                "size": size,
+                "date": date,
+                "labels": labels,
+                "placements": placements,
+                # Repainted by the next render while this one may still be waiting to be encoded
+                "image": shopImage.copy(),
+                "degraded": degraded,
+            }
+        else:
+            self.previous_render = None
+
+        return shopImage
+
+    @staticmethod
+    def parse_sections(itemshop: dict) -> list:
+        """
+        Return the (name, entries) of every non-empty section in the provided Item Shop,
+        Featured and Daily first followed by the others in the order they were returned.
+        """
+        sections = []
+        for key, section in itemshop.items():
+            if (not isinstance(section, dict)) or (not isinstance(section.get("entries"), list)):
+                continue
+            if len(section["entries"]) <= 0:
+                continue
+
+            # Sections without a display name are named after their key, specialFeatured => SPECIAL FEATURED
+            name = section.get("name") or re.sub(r"(?<!^)(?=[A-Z])", " ", key)
+            sections.append((key, name.upper(), section["entries"]))
+
+        order = {"featured": 0, "daily": 1}
+        sections.sort(key=lambda section: order.get(section[0], len(order)))
+        return [(name, entries) for _, name, entries in sections]
+
+    def encode_outputs(self, shopImage: Image.Image, page: int = None) -> dict:
+        """
+        Encode the provided image for every configured destination and variant in parallel.
+
+        Return the encoded images by destination and variant name, None if encoding failed.
+        """
+        outputs = {destination: (None, encoder) for destination, encoder in self.encoders.items()}
+        for variant in self.variants:
+            outputs[variant["name"]] = (variant["width"], variant["encoder"])
+
+        try:
+            # Outputs sharing the same width and settings share a single encode
+            with ThreadPoolExecutor(max_workers=len(set(outputs.values()))) as executor:
+                futures = {}
+                for name, output in outputs.items():
+                    if output not in futures:
+                        futures[output] = executor.submit(self.encode_image, shopImage, name, *output)
+                encoded = {output: future.result() for output, future in futures.items()}
+
+            return {name: RenderedImage(name, encoded[output], output[1], page) for name, output in outputs.items()}
+        except Exception as error:
+            log.critical(f"ImageGeneration => Failed to encode Item Shop image => {error}")
+        return None
+
+    def save_images(self, pages: list) -> None:
+        """Write the encoded images of the provided pages to disk and the archive when they are enabled."""
+        if self.config.save_file:
+            for image in [image for images in pages for image in images.values()]:
+                try:
+                    image.save()
+                except Exception as error:
+                    log.error(f"ImageGeneration => Failed to save {image.filename} => {error}")
+
+        if self.archive is not None:
+            try:
+                self.archive.publish(pages)
+            except Exception as error:
+                log.error(f"ImageGeneration => Failed to archive Item Shop images => {error}")
+
+    def encode_image(self, shopImage: Image.Image, name: str, width: int, encoder: ImageEncoder) -> bytes:
+        """Return the provided image, optionally downscaled to the specified width, encoded by encoder."""
+        start = time.perf_counter()
+        with timed("encode"):
+            if width is not None:
+                shopImage = self.image_utility.reduce(shopImage, width)
+            data, choice = encoder.encode_reporting(shopImage)
+
+        log.info(
+            f"ImageGeneration => Encoded {name} {shopImage.width}x{shopImage.height} ({encoder.describe()}) => "
+            f"{len(data):,} bytes in {(time.perf_counter() - start):.3f}s"
+        )
+        if choice is not None:
+            log.info(f"ImageGeneration => Byte budget for {name} => chose {choice}")
+        return data
+
+    def stream_image(
+        self, date: str, size: tuple, placements: list, labels: list, page: int = None, deadline: float = None, missing: list = None
+    ) -> dict:
+        """
+        Render the Item Shop image one row band at a time, compressing each band into a PNG
+        as soon as it is complete so only a single uncompressed band is held in memory.
+
+        Return the encoded image as the `file` destination, None if generation failed.
+        """
+        width, height = size
+        # The header occupies the first band followed by one band per row of cards
+        bands = [(0, ShopLayout.HEADER_HEIGHT)] + [
+            (top, top + ShopLayout.CELL_HEIGHT) for top in range(ShopLayout.HEADER_HEIGHT, height, ShopLayout.CELL_HEIGHT)
+        ]
+
+        background = self.image_utility.open("background.png")
+        if background is None:
+            log.warning("ImageGeneration => Failed to open background.png, defaulting to dark gray")
+
+        if len(self.variants) > 0:
+            log.warning("ImageGeneration => Variants are not generated when streaming the image")
+
+        try:
+            output = io.BytesIO()
+            writer = PNGStreamWriter(output, width, height)
+
+            for top, bottom in bands:
+                band = Image.new("RGB", (width, bottom - top))
+                if background is not None:
+                    band.paste(self.image_utility.resize_region(background, width, height, (0, top, width, bottom)))
+                else:
+                    band.paste((34, 37, 40), [0, 0, band.width, band.height])
+
+                if top == 0:
+                    self.draw_header(band, date, labels)
+
+                for item, x, y in placements:
+                    if top <= y < bottom:
+                        card = self.generate_card(item, deadline)
+                        if card is not None:
+                            band.paste(card, (x, y - top), card)
+                            if card.info.get("missingIcon") and (missing is not None):
+                                missing.append(item)
+
+                writer.write_band(band)
+            writer.close()
+
+            # The streamed image is always PNG and is shared by every destination
+            return {"file": RenderedImage("file", output.getvalue(), ImageEncoder({"format": "png"}), page)}
+        except Exception as error:
+            log.critical(f"ImageGeneration => Failed to stream Item Shop image => {error}")
+        return None
+
+    def paint_background(self, shopImage: Image.Image, region: tuple = None) -> None:
+        """
+        Fill the provided image, or only the (left, top, right, bottom) region of it,
+        with the resized background, or dark gray if unavailable.
+        """
+        if region is None:
+            region = (0, 0, shopImage.width, shopImage.height)
+
+        background = self.image_utility.open("background.png")
+        if background is not None:
+            background = self.image_utility.resize_region(background, shopImage.width, shopImage.height, region)
+            shopImage.paste(background, region[:2])
+        else:
+            log.warning("ImageGeneration => Failed to open background.png, defaulting to dark gray")
+            shopImage.paste((34, 37, 40), region)
+
+    def draw_header(self, shopImage: Image.Image, date: str, labels: list) -> None:
+        """Blit the header strip for the provided date and section labels onto the provided image."""
+        header = self.render_header(date, shopImage.width, labels)
+        shopImage.paste(header, (0, 0), header)
+
+    def render_header(self, date: str, width: int, labels: list) -> Image.Image:
+        """
+        Return the transparent header strip holding the title, date and the (name, x, width)
+        section labels, shrinking labels which are wider than their section.
+
+        Strips are cached per language, date, width, labels and font size so repeated
+        renders skip the text rasterization.
+        """
+        key = (self.config.language, date, width, tuple(labels), self.HEADER_FONT_SIZE)
+        with self.header_lock:
+            if key in self.header_cache:
+                self.header_cache.move_to_end(key)
+                return self.header_cache[key]
+
+        header = Image.new("RGBA", (width, ShopLayout.HEADER_HEIGHT))
+        canvas = ImageDraw.Draw(header)
+        font = self.image_utility.font(self.HEADER_FONT_SIZE)
+
+        textWidth, _ = font.getsize("FORTNITE ITEM SHOP")
+        canvas.text(self.image_utility.align_center(textWidth, width, 30), "FORTNITE ITEM SHOP", (255, 255, 255), font=font)
+        textWidth, _ = font.getsize(date.upper())
+        canvas.text(self.image_utility.align_center(textWidth, width, 120), date.upper(), (255, 255, 255), font=font)
+
+        for name, x, labelWidth in labels:
+            font, _, change = self.image_utility.fit_text(name, self.HEADER_FONT_SIZE, labelWidth)
+            canvas.text((x, (240 + (change / 2))), name, (255, 255, 255), font=font, anchor=None, spacing=4, align="left")
+
+        with self.header_lock:
+            self.header_cache[key] = header
+            while len(self.header_cache) > self.HEADER_CACHE_SIZE:
+                self.header_cache.popitem(last=False)
+        return header
+
+    @classmethod
+    def icon_url(cls, item: dict) -> str:
+        """Return the url of the icon shown on the card of the provided item."""
+        if item.get("bundle"):
+            return item["bundle"]["image"]
+        return item["items"][0]["images"]["featured"] or item["items"][0]["images"]["icon"]
+
+    @classmethod
+    def icon_urls(cls, sections: list) -> list:
+        """Return the icon urls of every entry in the provided (name, entries) sections."""
+        urls = []
+        for _, entries in sections:
+            for item in entries:
+                try:
+                    urls.append(cls.icon_url(item))
+                except Exception:
+                    # Items which fail to parse are reported when their card is generated
+                    pass
+        return urls
+
+    def arrival_order(self, placements: list, deadline: float = None):
+        """
+        Yield the provided (item, x, y) placements in the order their prefetched icons finish
+        downloading, so cards render as their icons arrive. Placements whose icon was not
+        prefetched come last, as do those whose icon has not arrived by the deadline.
+        """
+        pending = {}
+        remaining = []
+        for placement in placements:
+            try:
+                future = self.image_utility.prefetched.get(self.icon_url(placement[0]))
+            except Exception:
+                future = None
+
+            if future is None:
+                remaining.append(placement)
+            else:
+                pending.setdefault(future, []).append(placement)
+
+        try:
+            for future in as_completed(pending, timeout=None if deadline is None else max(deadline - time.time(), 0)):
+                yield from pending.pop(future)
+        except FutureTimeoutError:
+            pass
+        for late in pending.values():
+            yield from late
+        yield from remaining
+
+    @staticmethod
+    def card_signature(item: dict) -> str:
+        """Return a key which is identical for Item Shop entries that render the same card."""
+        return json.dumps(item, sort_keys=True)
+
+    def cached_card(self, item: dict, deadline: float = None) -> Image.Image:
+        """Return the card for the provided item, reusing the card rendered for the previous Item Shop."""
+        signature = self.card_signature(item)
+        card_lookups.inc(result="hit" if signature in self.card_cache else "miss")
+        if signature not in self.card_cache:
+            card = self.generate_card(item, deadline)
+            if card is None:
+                return None
+            if card.info.get("missingIcon"):
+                # Rendered again next time, once the icon may be available
+                return card
+            self.card_cache[signature] = card
+        return self.card_cache[signature]
+
+    def remember_icon(self, url: str, icon: Image.Image) -> None:
+        with self.icon_lock:
+            self.icon_cache[url] = icon
+            self.icon_cache.move_to_end(url)
+            while len(self.icon_cache) > self.ICON_CACHE_SIZE:
+                self.icon_cache.popitem(last=False)
+
+    def placeholder_icon(self, url: str) -> Image.Image:
+        """Return the last icon downloaded from url, or a generic question mark if there is none."""
+        with self.icon_lock:
+            icon = self.icon_cache.get(url)
+            if icon is not None:
+                return icon
+
+            if self.placeholder is None:
+                self.placeholder = Image.new("RGBA", (ShopLayout.CARD_WIDTH, 365))
+                font = self.image_utility.font(250)
+                width, height = font.getsize("?")
+                ImageDraw.Draw(self.placeholder).text(
+                    self.image_utility.align_center(width, self.placeholder.width, (self.placeholder.height - height) // 2),
+                    "?",
+                    (255, 255, 255, 96),
+                    font=font,
+                )
+            return self.placeholder
+
+    @timed("card")
+    def generate_card(self, item: dict, deadline: float = None) -> Image.Image:
+        """
+        Return the card image for the provided Fortnite Item Shop item.
+
+        When the icon fails to download or does not arrive by the deadline, a time.time()
+        timestamp, the card shows a placeholder instead, or nothing if placeholders are
+        disabled, and is flagged by `missingIcon` in its info.
+        """
+        try:
+            name = item["items"][0]["name"].lower()
+            rarity = item["items"][0]["rarity"]["value"].lower()
+            category = item["items"][0]["type"]["value"].lower()
+            price = item["finalPrice"]
+
+            icon = self.icon_url(item)
+
+            if(item["bundle"]):
+                name = item["bundle"]["name"].lower()
+                category = "Bundle".lower()
+        except Exception as error:
+            log.error(f"CardGeneration => Failed to parse item {name} => {error}")
+            return None
+
+        if rarity == "frozen":
+            blendColor = (148, 223, 255)
+        elif rarity == "lava":
+            blendColor = (234, 141, 35)
+        elif rarity == "legendary":
+            blendColor = (211, 120, 65)
+        elif rarity == "slurp":
+            blendColor = (0, 233, 176)
+        elif rarity == "dark":
+            blendColor = (251, 34, 223)
+        elif rarity == "starwars":
+            blendColor = (231, 196, 19)
+        elif rarity == "marvel":
+            blendColor = (197, 51, 52)
+        elif rarity == "dc":
+            blendColor = (84, 117, 199)
+        elif rarity == "icon":
+            blendColor = (54, 183, 183)
+        elif rarity == "shadow":
+            blendColor = (113, 113, 113)
+        elif rarity == "gaminglegends":
+            blendColor = (117, 129, 209)
+            rarity = "GamingLegends"
+        elif rarity == "epic":
+            blendColor = (177, 91, 226)
+        elif rarity == "rare":
+            blendColor = (73, 172, 242)
+        elif rarity == "uncommon":
+            blendColor = (96, 170, 58)
+        elif rarity == "common":
+            blendColor = (190, 190, 190)
+        else:
+            blendColor = (255, 255, 255)
+
+        card = Image.new("RGBA", (ShopLayout.CARD_WIDTH, ShopLayout.CARD_HEIGHT))
+
+        layer = self.image_utility.open(f"shopTemplates/{rarity.capitalize()}BG.png")
+        if layer is None:
+            log.warn(f"CardGeneration => Failed to open {rarity.capitalize()}BG.png, defaulted to Common")
+            layer = self.image_utility.open("shopTemplates/CommonBG.png")
+        card.paste(layer)
+
+        url = icon
+        icon = self.image_utility.fetch(url, deadline)
+        if icon is not None:
+            if (category == "outfit") or (category == "emote"):
+                icon = self.image_utility.resize(icon, 285, 365)
+            elif category == "wrap":
+                icon = self.image_utility.resize(icon, 230, 310)
+            else:
+                icon = self.image_utility.resize(icon, 310, 390)
+            self.remember_icon(url, icon)
+        else:
+            card.info["missingIcon"] = True
+            if self.config.late_placeholder:
+                icon = self.placeholder_icon(url)
+
+        if icon is not None:
+            if (category == "outfit") or (category == "emote"):
+                card.paste(icon, self.image_utility.align_center(icon.width, card.width), icon)
+            else:
+                card.paste(icon, self.image_utility.align_center(icon.width, card.width, 15), icon)
+
+        layer = self.image_utility.open(f"shopTemplates/{rarity.capitalize()}OV.png")
+        if layer is None:
+            log.warn(f"CardGeneration => Failed to open {rarity.capitalize()}OV.png, defaulted to Common")
+            layer = self.image_utility.open("shopTemplates/CommonOV.png")
+        card.paste(layer, layer)
+
+        canvas = ImageDraw.Draw(card)
+
+        vbucks = self.image_utility.resize(
+            self.image_utility.open("vbucks.png"),
+            40, 40
+        )
+
+        font = self.image_utility.font(40)
+        price = str(f"{price:,}")
+        textWidth, _ = font.getsize(price)
+
+        canvas.text(self.image_utility.align_center(((textWidth - 5) - vbucks.width), card.width, 347), price, (255, 255, 255), font=font)
+        card.paste(vbucks, self.image_utility.align_center((vbucks.width + (textWidth + 5)), card.width, 350), vbucks)
+
+        itemName = name.upper().replace(" OUTFIT", "").replace(" PICKAXE", "").replace(" BUNDLE", "")
+        if category == "bundle":
+            itemName = name.upper().replace(" BUNDLE", "")
+
+        font, text_width, change = self.image_utility.fit_text(itemName, 40, 260)
+        canvas.text(self.image_utility.align_center(text_width, card.width, (400 + (change / 2))), itemName, (255, 255, 255), font=font)
+
+        categoryName = category.upper()
+        font, text_width, change = self.image_utility.fit_text(categoryName, 40, 260)
+        canvas.text(self.image_utility.align_center(text_width, card.width, (450 + (change / 2))), categoryName, blendColor, font=font)
+        return card
@@ -0,0 +1,519 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+import subprocess
+import coloredlogs
+from io import BytesIO
+from PIL import Image
+from athena import Athena
+from compositor import NumpyCompositor
+from encoders import ImageEncoder, RenderedImage
+from layout import ShopLayout
+from publishers import TwitterPublisher
+from standin import StandInServer
+from utilty import ConfgFile, ImageUtility
+
+log = logging.getLogger(__name__)
+coloredlogs.install(level="INFO", fmt="[%(asctime)s] %(message)s", datefmt="%I:%M:%S")
+
+# Modules a `--once` run without an Item Shop change must not import
+DEFERRED_MODULES = ["PIL", "twitter", "coloredlogs", "numpy", "boto3", "athena", "encoders", "publishers"]
+
+# Representative encoder settings compared by the encoders benchmark
+ENCODER_SETTINGS = {
+    "jpeg-baseline": {"format": "jpeg", "quality": 85, "optimize": False},
+    "jpeg-optimized": {"format": "jpeg", "quality": 85, "optimize": True},
+    "jpeg-progressive": {"format": "jpeg", "quality": 85, "optimize": True, "progressive": True},
+    "jpeg-444": {"format": "jpeg", "quality": 85, "optimize": True, "subsampling": "4:4:4"},
+    "jpeg-420": {"format": "jpeg", "quality": 85, "optimize": True, "subsampling": "4:2:0"},
+    "webp-80": {"format": "webp", "quality": 80, "method": 4},
+    "webp-80-fast": {"format": "webp", "quality": 80, "method": 0},
+    "png": {"format": "png", "optimize": False, "compressLevel": 6},
+    "png-fast": {"format": "png", "optimize": False, "compressLevel": 1},
+}
+
+# Icon sizes of the card categories, as resized by Athena.generate_card
+RESIZE_TARGETS = {"outfit": (285, 365), "wrap": (230, 310), "other": (310, 390)}
+
+
+def measure(function, repeat: int) -> list:
+    """Return the duration in seconds of each of the repeated calls to function."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def benchmark_encoders(images: list, settings: dict, repeat: int) -> list:
+    """Return the encode time and size of every image for every encoder setting."""
+    results = []
+    for filename in images:
+        image = Image.open(filename).convert("RGB")
+
+        for name, options in settings.items():
+            encoder = ImageEncoder(options)
+            size = len(encoder.encode(image))
+            durations = measure(lambda: encoder.encode(image), repeat)
+
+            results.append({
+                "image": filename,
+                "width": image.width,
+                "height": image.height,
+                "encoder": name,
+                "settings": encoder.describe(),
+                "bytes": size,
+                "median": statistics.median(durations),
+                "min": min(durations),
+            })
+            log.info(f"Benchmark => {filename} => {name:<18} {size:>12,} bytes {statistics.median(durations):>8.3f}s")
+    return results
+
+
+def benchmark_layout(shops: list, aspect_ratio: float, repeat: int) -> list:
+    """Return the time taken to compute the layout of Item Shops with the provided section sizes."""
+    results = []
+    for entries in shops:
+        durations = measure(lambda: ShopLayout.compute(entries, aspect_ratio), repeat)
+        layout = ShopLayout.compute(entries, aspect_ratio)
+
+        results.append({
+            "entries": entries,
+            "columns": [section.columns for section in layout.sections],
+            "width": layout.width,
+            "height": layout.height,
+            "median": statistics.median(durations),
+            "min": min(durations),
+        })
+        log.info(
+            f"Benchmark => layout {entries} => {layout.width}x{layout.height} "
+            f"{statistics.median(durations) * 1000000:>10.1f}us"
+        )
+    return results
+
+
+def benchmark_compositor(shops: list, repeat: int) -> list:
+    """Return the time taken to composite cards with the Pillow paste loop and the NumPy compositor."""
+    # Stand-in card, the shop template layers composited like a real card
+    card = Image.new("RGBA", (ShopLayout.CARD_WIDTH, ShopLayout.CARD_HEIGHT))
+    card.paste(Image.open("assets/images/shopTemplates/EpicBG.png"))
+    overlay = Image.open("assets/images/shopTemplates/EpicOV.png").convert("RGBA")
+    card.paste(overlay, overlay)
+
+    results = []
+    for entries in shops:
+        layout = ShopLayout.compute(entries)
+        background = Image.new("RGB", layout.size, (34, 37, 40))
+        cards = [(card, x, y) for x, y in layout.positions]
+
+        def paste():
+            shopImage = background.copy()
+            for image, x, y in cards:
+                shopImage.paste(image, (x, y), image)
+
+        def numpy():
+            compositor = NumpyCompositor(background)
+            compositor.blit(cards)
+            compositor.to_image()
+
+        result = {"entries": entries, "width": layout.width, "height": layout.height}
+        for name, function in (("pillow", paste), ("numpy", numpy)):
+            if (name == "numpy") and not NumpyCompositor.available():
+                continue
+            durations = measure(function, repeat)
+            result[name] = {"median": statistics.median(durations), "min": min(durations)}
+            log.info(f"Benchmark => compositor {name:<6} {entries} => {statistics.median(durations):>8.3f}s")
+        results.append(result)
+    return results
+
+
+def benchmark_publish(filename: str, count: int, latency: float, error_rate: float, chunk_size: int, max_attempts: int) -> dict:
+    """Return the time taken to Tweet an image to the local stand-in API, retrying failures like the publish queue."""
+    server = StandInServer(latency=latency, jitter=0.2, error_rate=error_rate)
+    server.start()
+
+    encoder = ImageEncoder({"format": "jpeg", "quality": 85, "optimize": True})
+    image = RenderedImage("twitter", encoder.encode(Image.open(filename).convert("RGB")), encoder)
+    publisher = TwitterPublisher("key", "secret", "token", "secret", chunk_size=chunk_size, base_url=server.url, upload_url=server.url)
+
+    durations = []
+    attempts = []
+    failures = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        for attempt in range(1, max_attempts + 1):
+            if publisher.publish("Benchmark", [image]):
+                break
+        else:
+            failures += 1
+        durations.append(time.perf_counter() - start)
+        attempts.append(attempt)
+
+    server.shutdown()
+    result = {
+        "image": filename,
+        "bytes": image.size,
+        "chunkSize": chunk_size,
+        "latency": latency,
+        "errorRate": error_rate,
+        "published": count - failures,
+        "failed": failures,
+        "attempts": statistics.mean(attempts),
+        "median": statistics.median(durations),
+        "max": max(durations),
+        "throughput": count / sum(durations),
+        "server": server.stats(),
+    }
+    log.info(
+        f"Benchmark => publish {image.size:,} bytes => {result['published']}/{count} published, "
+        f"{result['attempts']:.2f} attempts, median {result['median']:.3f}s, {result['throughput']:.2f}/s"
+    )
+    return result
+
+
+def load_fixtures(directory: str) -> tuple:
+    """Return the recorded Item Shop response and the local files of its icons by url."""
+    with open(os.path.join(directory, "itemshop.json"), "r", encoding="utf-8") as data:
+        shop = json.load(data)
+    with open(os.path.join(directory, "icons.json"), "r", encoding="utf-8") as data:
+        icons = json.load(data)
+    return shop, icons
+
+
+def serve_fixtures(icons: dict) -> None:
+    """Download the icons from the fixtures instead of the CDN, so the render benchmarks run offline."""
+
+    def download(url: str, timeout: tuple = None) -> Image.Image:
+        # Copies made by scale_shop share the icon of their original
+        with open(icons[url.split("?")[0]], "rb") as icon:
+            return Image.open(BytesIO(icon.read())).convert("RGBA")
+
+    ImageUtility.download = staticmethod(download)
+
+
+def scale_shop(shop: dict, entries: int) -> dict:
+    """
+    Return the Item Shop data of the recorded response with its sections repeated or cut to
+    the provided total number of entries, in the same proportions. Repeated entries are
+    distinct copies with their own icon url, so none of them shares a card.
+    """
+
+    def copy(entry: dict, index: int) -> dict:
+        if index == 0:
+            return entry
+        entry = json.loads(json.dumps(entry))
+        for item in entry["items"]:
+            item["id"] = f"{item['id']}_{index}"
+            item["images"] = {kind: url and f"{url}?copy={index}" for kind, url in item["images"].items()}
+        if entry.get("bundle"):
+            entry["bundle"]["image"] = f"{entry['bundle']['image']}?copy={index}"
+        return entry
+
+    data = dict(shop["data"])
+    keys = [key for key, section in data.items() if isinstance(section, dict) and section.get("entries")]
+    total = sum(len(data[key]["entries"]) for key in keys)
+
+    remaining = entries
+    for index, key in enumerate(keys):
+        recorded = data[key]["entries"]
+        count = remaining if index == len(keys) - 1 else round(entries * len(recorded) / total)
+        remaining -= count
+        data[key] = {**data[key], "entries": [copy(recorded[i % len(recorded)], i // len(recorded)) for i in range(count)]}
+    return data
+
+
+def render_athena() -> Athena:
+    """Return an Athena which renders and encodes like configured by default, without saving or publishing."""
+    config = ConfgFile()
+    config.save_file = False
+    config.publish_queue = ":memory:"
+    return Athena(config)
+
+
+def benchmark_fit_text(shop: dict, repeat: int) -> list:
+    """Return the time taken to fit the name and category of every recorded item on its card."""
+    utility = ImageUtility()
+    texts = []
+    for _, entries in Athena.parse_sections(shop["data"]):
+        for entry in entries:
+            name = entry["bundle"]["name"] if entry.get("bundle") else entry["items"][0]["name"]
+            texts += [name.upper(), entry["items"][0]["type"]["displayValue"].upper()]
+
+    results = []
+    for text in dict.fromkeys(texts):
+        # Fonts are loaded once and shared, as while tracking
+        _, width, change = utility.fit_text(text, 40, 260)
+        durations = measure(lambda: utility.fit_text(text, 40, 260), repeat)
+
+        results.append({
+            "name": text,
+            "width": width,
+            "change": change,
+            "median": statistics.median(durations),
+            "min": min(durations),
+        })
+        log.info(f"Benchmark => fit_text {text:<24} shrunk {change:>2} => {statistics.median(durations) * 1000000:>10.1f}us")
+    return results
+
+
+def benchmark_resize(icons: dict, repeat: int) -> list:
+    """Return the time taken to resize every recorded icon to the size of every card category."""
+    images = [Image.open(filename).convert("RGBA") for filename in sorted(set(icons.values()))]
+
+    results = []
+    for name, (width, height) in RESIZE_TARGETS.items():
+        durations = [duration for image in images for duration in measure(lambda: ImageUtility.resize(image, width, height), repeat)]
+
+        results.append({
+            "name": name,
+            "size": [width, height],
+            "icons": len(images),
+            "median": statistics.median(durations),
+            "min": min(durations),
+        })
+        log.info(f"Benchmark => resize {name:<6} {width}x{height} => {statistics.median(durations) * 1000:>8.3f}ms")
+    return results
+
+
+def benchmark_cards(shop: dict, repeat: int) -> dict:
+    """
+    Return the time taken to generate the card of every recorded item, cold with empty image
+    and font caches and the icon still to be decoded, and warm with the caches loaded and the
+    icon prefetched, as after the warm-up.
+    """
+    athena = render_athena()
+    items = [entry for _, entries in Athena.parse_sections(shop["data"]) for entry in entries]
+    urls = [Athena.icon_url(item) for item in items]
+
+    cold = []
+    for _ in range(repeat):
+        for item in items:
+            ImageUtility.images.clear()
+            ImageUtility.fonts.clear()
+            athena.image_utility.discard(urls)
+            cold += measure(lambda: athena.generate_card(item), 1)
+
+    for future in athena.image_utility.prefetch(urls).values():
+        future.result()
+    warm = [duration for item in items for duration in measure(lambda: athena.generate_card(item), repeat)]
+
+    result = {"name": "cards", "cards": len(items)}
+    for name, durations in (("cold", cold), ("warm", warm)):
+        result[name] = {"median": statistics.median(durations), "min": min(durations), "max": max(durations)}
+        log.info(f"Benchmark => generate_card {name} => median {statistics.median(durations) * 1000:>8.3f}ms max {max(durations) * 1000:>8.3f}ms")
+    return result
+
+
+def benchmark_image(shop: dict, sizes: list, repeat: int) -> list:
+    """
+    Return the time taken to generate, from the prefetch of its icons to its encoded images,
+    the recorded Item Shop scaled to each of the provided numbers of entries. First renders
+    start with an empty card cache, repeated renders reuse the cards of the previous one.
+    """
+    athena = render_athena()
+    date = "Tuesday, February 14"
+
+    results = []
+    for entries in sizes:
+        data = scale_shop(shop, entries)
+        urls = Athena.icon_urls(Athena.parse_sections(data))
+
+        def generate():
+            athena.image_utility.prefetch(urls)
+            return athena.generate_image(date, data)
+
+        first = []
+        repeated = []
+        for _ in range(repeat):
+            athena.card_cache.clear()
+            athena.previous_render = None
+            athena.image_utility.discard(urls)
+            first += measure(generate, 1)
+            repeated += measure(generate, 1)
+
+        pages = generate()
+        result = {"name": f"{entries} entries", "entries": entries, "bytes": sum(page["file"].size for page in pages)}
+        for name, durations in (("first", first), ("repeated", repeated)):
+            result[name] = {"median": statistics.median(durations), "min": min(durations)}
+        results.append(result)
+        log.info(
+            f"Benchmark => generate_image {entries:>3} entries => first {result['first']['median']:>7.3f}s "
+            f"repeated {result['repeated']['median']:>7.3f}s"
+        )
+    return results
+
+
+def medians(results, path: str = "") -> dict:
+    """Return the median of every measurement in the provided results by its path."""
+    if isinstance(results, dict):
+        if "median" in results:
+            return {path: results["median"]}
+        found = {}
+        for key, value in results.items():
+            found.update(medians(value, f"{path}.{key}" if path else key))
+        return found
+    if isinstance(results, list):
+        found = {}
+        for index, value in enumerate(results):
+            name = value.get("name", index) if isinstance(value, dict) else index
+            found.update(medians(value, f"{path}[{name}]"))
+        return found
+    return {}
+
+
+def compare(results, baseline_file: str) -> None:
+    """Log the change of every median against the same measurement in a previous results file."""
+    with open(baseline_file, "r", encoding="utf-8") as data:
+        baseline = medians(json.load(data).get("results"))
+
+    for path, median in medians(results).items():
+        previous = baseline.get(path)
+        if not previous:
+            continue
+        log.info(f"Benchmark => {path:<48} {previous:>10.6f}s => {median:>10.6f}s {((median / previous) - 1) * 100:>+7.1f}%")
+
+
+def revision() -> str:
+    """Return the commit being benchmarked, None outside of a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_imports(module: str, repeat: int, budget: float) -> dict:
+    """Return the time taken to import module in a fresh interpreter and the deferred modules it imported."""
+    script = (
+        "import sys, json, time\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "duration = time.perf_counter() - start\n"
+        f"print(json.dumps({{'duration': duration, 'loaded': [name for name in {DEFERRED_MODULES!r} if name in sys.modules]}}))\n"
+    )
+
+    durations = []
+    loaded = set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        durations.append(result["duration"])
+        loaded.update(result["loaded"])
+
+    result = {
+        "module": module,
+        "budget": budget,
+        "median": statistics.median(durations),
+        "max": max(durations),
+        "loaded": sorted(loaded),
+        "passed": (max(durations) <= budget) and (len(loaded) == 0),
+    }
+    log.info(f"Benchmark => import {module} => median {result['median']:.3f}s max {result['max']:.3f}s, budget {budget:.3f}s")
+    if len(loaded) > 0:
+        log.error(f"Benchmark => import {module} => imported deferred modules {', '.join(sorted(loaded))}")
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Athena render benchmarks")
+    subparsers = parser.add_subparsers(dest="suite", required=True)
+
+    encoders = subparsers.add_parser("encoders", help="Compare encode time and size of the encoder settings")
+    encoders.add_argument("images", nargs="*", default=["example.jpeg"], help="Representative Item Shop images")
+    encoders.add_argument("--settings", help="JSON file of named encoder settings to compare instead of the defaults")
+    encoders.add_argument("--repeat", type=int, default=3)
+    encoders.add_argument("--output", help="Write the results to this JSON file")
+
+    layout = subparsers.add_parser("layout", help="Time the layout engine without any pixel work")
+    layout.add_argument("--aspect-ratio", type=float, default=1.0)
+    layout.add_argument("--repeat", type=int, default=1000)
+    layout.add_argument("--output", help="Write the results to this JSON file")
+
+    compositor = subparsers.add_parser("compositor", help="Compare the Pillow paste loop with the NumPy compositor")
+    compositor.add_argument("--repeat", type=int, default=5)
+    compositor.add_argument("--output", help="Write the results to this JSON file")
+
+    publish = subparsers.add_parser("publish", help="Tweet an image to the local stand-in Twitter API")
+    publish.add_argument("image", nargs="?", default="example.jpeg")
+    publish.add_argument("--count", type=int, default=20)
+    publish.add_argument("--latency", type=float, default=0.05, help="Seconds each stand-in request is delayed by")
+    publish.add_argument("--error-rate", type=float, default=0.1, help="Fraction of stand-in requests which fail")
+    publish.add_argument("--chunk-size", type=int, default=1048576)
+    publish.add_argument("--max-attempts", type=int, default=5)
+    publish.add_argument("--output", help="Write the results to this JSON file")
+
+    imports = subparsers.add_parser("imports", help="Check the import time of itemshop.py against a budget")
+    imports.add_argument("--module", default="itemshop")
+    imports.add_argument("--budget", type=float, default=0.5, help="Seconds the import may take")
+    imports.add_argument("--repeat", type=int, default=5)
+    imports.add_argument("--output", help="Write the results to this JSON file")
+
+    # Render hot paths, measured offline against the recorded fixtures
+    renders = {
+        "fit-text": "Time fitting the recorded item names and categories on their cards",
+        "resize": "Time resizing the recorded icons to every card category",
+        "cards": "Time generating the recorded cards with cold and warm caches",
+        "image": "Time generating the recorded Item Shop end to end at several sizes",
+    }
+    for suite, description in renders.items():
+        render = subparsers.add_parser(suite, help=description)
+        render.add_argument("--fixtures", default="fixtures", help="Directory of the recorded Item Shop and icons")
+        render.add_argument("--repeat", type=int, default={"fit-text": 200, "resize": 20, "cards": 5, "image": 3}[suite])
+        if suite == "image":
+            render.add_argument("--entries", type=int, nargs="+", default=[12, 24, 48, 96], help="Item Shop sizes")
+        render.add_argument("--baseline", help="Compare with the results written to this JSON file by a previous commit")
+        render.add_argument("--output", help="Write the results to this JSON file")
+
+    arguments = parser.parse_args()
+
+    if arguments.suite == "encoders":
+        settings = ENCODER_SETTINGS
+        if arguments.settings is not None:
+            with open(arguments.settings, "r", encoding="utf-8") as data:
+                settings = json.load(data)
+        results = benchmark_encoders(arguments.images, settings, arguments.repeat)
+    elif arguments.suite == "layout":
+        shops = [[6, 6], [12, 6], [18, 12], [24, 20], [40, 30, 10], [80, 60, 20, 10]]
+        results = benchmark_layout(shops, arguments.aspect_ratio, arguments.repeat)
+    elif arguments.suite == "compositor":
+        shops = [[12, 6], [24, 20], [40, 30, 10], [80, 60, 20, 10]]
+        results = benchmark_compositor(shops, arguments.repeat)
+    elif arguments.suite == "publish":
+        results = benchmark_publish(
+            arguments.image, arguments.count, arguments.latency, arguments.error_rate, arguments.chunk_size, arguments.max_attempts
+        )
+
+    elif arguments.suite == "imports":
+        results = benchmark_imports(arguments.module, arguments.repeat, arguments.budget)
+    elif arguments.suite in renders:
+        # Every render logs its progress, only the results are of interest here
+        logging.getLogger("athena").setLevel(logging.WARNING)
+        shop, icons = load_fixtures(arguments.fixtures)
+        serve_fixtures(icons)
+        if arguments.suite == "fit-text":
+            results = benchmark_fit_text(shop, arguments.repeat)
+        elif arguments.suite == "resize":
+            results = benchmark_resize(icons, arguments.repeat)
+        elif arguments.suite == "cards":
+            results = benchmark_cards(shop, arguments.repeat)
+        else:
+            results = benchmark_image(shop, arguments.entries, arguments.repeat)
+
+        if arguments.baseline is not None:
+            compare(results, arguments.baseline)
+        results = {"suite": arguments.suite, "revision": revision(), "repeat": arguments.repeat, "results": results}
+
+    if arguments.output is not None:
+        with open(arguments.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=4)
+
+    if (arguments.suite == "imports") and not results["passed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import logging
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class NumpyCompositor:
+    """
+    Canvas held as a preallocated NumPy array which RGBA cards are alpha blended into
+    in vectorized batches, converted back to a Pillow image once for encoding.
+
+    Only used by `benchmark.py compositor`, where it is several times slower than the
+    Pillow paste loop, so the renderer keeps pasting. NumPy is optional, check
+    `NumpyCompositor.available()` before use.
+    """
+
+    # Cards blended per batch, bounding the memory of the intermediate arrays
+    BATCH_SIZE = 16
+
+    canvas: "numpy.ndarray"
+
+    def __init__(self, image: Image.Image) -> None:
+        self.canvas = numpy.array(image.convert("RGB"), dtype=numpy.uint8)
+
+    @staticmethod
+    def available() -> bool:
+        return numpy is not None
+
+    def blit(self, cards: list) -> None:
+        """Alpha blend the provided (card, x, y) RGBA cards onto the canvas."""
+        # Cards of the same size are stacked and blended together
+        sizes = {}
+        for card, x, y in cards:
+            if (x < 0) or (y < 0) or (x + card.width > self.canvas.shape[1]) or (y + card.height > self.canvas.shape[0]):
+                raise ValueError(f"Card at ({x}, {y}) exceeds the canvas")
+            sizes.setdefault(card.size, []).append((card, x, y))
+
+        for (width, height), group in sizes.items():
+            for start in range(0, len(group), self.BATCH_SIZE):
+                self.blit_batch(group[start:start + self.BATCH_SIZE], width, height)
+
+    def blit_batch(self, cards: list, width: int, height: int) -> None:
+        pixels = numpy.empty((len(cards), height, width, 4), dtype=numpy.uint16)
+        regions = numpy.empty((len(cards), height, width, 3), dtype=numpy.uint16)
+        for index, (card, x, y) in enumerate(cards):
+            pixels[index] = numpy.asarray(card.convert("RGBA"))
+            regions[index] = self.canvas[y:y + height, x:x + width]
+
+        # out = (card * alpha + canvas * (255 - alpha)) / 255, computed in place on the whole batch
+        alpha = pixels[..., 3:]
+        color = pixels[..., :3]
+        color *= alpha
+        regions *= (255 - alpha)
+        regions += color
+        regions += 128
+        # Exact rounded division by 255 for values below 65536
+        regions += regions >> 8
+        regions >>= 8
+
+        for index, (_, x, y) in enumerate(cards):
+            self.canvas[y:y + height, x:x + width] = regions[index]
+
+    def to_image(self) -> Image.Image:
+        return Image.fromarray(self.canvas, "RGB")
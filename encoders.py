@@ -0,0 +1,328 @@
+import io
+import math
+import hashlib
+import zlib
+import struct
+import logging
+import threading
+from PIL import Image
+from utilty import write_atomic
+
+log = logging.getLogger(__name__)
+
+
+class PNGStreamWriter:
+    """
+    Incremental PNG encoder which accepts the image as a sequence of horizontal
+    bands, so the full image never has to exist in memory at once.
+    """
+
+    SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def __init__(self, fp, width: int, height: int, compress_level: int = 6) -> None:
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(compress_level)
+
+        self.fp.write(self.SIGNATURE)
+        # 8-bit depth, color type 2 (RGB), default compression, filter and interlace
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, chunk_type: bytes, data: bytes) -> None:
+        self.fp.write(struct.pack(">I", len(data)))
+        self.fp.write(chunk_type)
+        self.fp.write(data)
+        self.fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+    def write_band(self, band: Image.Image) -> None:
+        """Compress and write the provided band, which must span the full image width."""
+        if band.mode != "RGB":
+            band = band.convert("RGB")
+        if band.width != self.width:
+            raise ValueError(f"Band width {band.width} does not match image width {self.width}")
+        if self.rows_written + band.height > self.height:
+            raise ValueError("Band exceeds the declared image height")
+
+        raw = band.tobytes()
+        stride = self.width * 3
+        # Every scanline is prefixed with its filter type, 0 (None)
+        scanlines = b"".join(
+            b"\x00" + raw[offset:offset + stride] for offset in range(0, len(raw), stride)
+        )
+
+        data = self.compressor.compress(scanlines)
+        if data:
+            self.write_chunk(b"IDAT", data)
+        self.rows_written += band.height
+
+    def close(self) -> None:
+        """Flush the remaining compressed data and terminate the PNG stream."""
+        if self.rows_written != self.height:
+            raise ValueError(f"Only {self.rows_written} of {self.height} rows were written")
+
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+
+
+class ImageEncoder:
+    """Encoder settings for a single output destination."""
+
+    # Pillow format name and file extension for each supported format
+    FORMATS = {
+        "jpeg": ("JPEG", "jpeg"),
+        "webp": ("WEBP", "webp"),
+        "png": ("PNG", "png"),
+    }
+
+    format: str = "jpeg"
+    quality: int = 85
+    optimize: bool = True
+    progressive: bool = False
+    subsampling: str = None
+    lossless: bool = False
+    method: int = 4
+    compress_level: int = 6
+    max_bytes: int = None
+    min_quality: int = 50
+    history: dict
+
+    # Downscaling attempts made when even the lowest quality exceeds the byte budget
+    MAX_SCALE_TRIALS = 6
+    MIN_SCALE = 0.1
+
+    def __init__(self, settings: dict = None) -> None:
+        settings = settings or {}
+
+        self.format = settings.get("format", self.format).lower()
+        if self.format not in self.FORMATS:
+            raise ValueError(f"Unsupported image format {self.format}")
+
+        self.quality = settings.get("quality", self.quality)
+        self.optimize = settings.get("optimize", self.optimize)
+        self.progressive = settings.get("progressive", self.progressive)
+        self.subsampling = settings.get("subsampling", self.subsampling)
+        self.lossless = settings.get("lossless", self.lossless)
+        self.method = settings.get("method", self.method)
+        self.compress_level = settings.get("compressLevel", self.compress_level)
+        self.max_bytes = settings.get("maxBytes", self.max_bytes)
+        self.min_quality = min(settings.get("minQuality", self.min_quality), self.quality)
+        # Pages are encoded in parallel, each reads and updates the estimate under the lock
+        self.history = {}
+        self.history_lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"ImageEncoder({self.describe()})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ImageEncoder) and (self.key() == other.key())
+
+    def __hash__(self) -> int:
+        return hash(self.key())
+
+    def key(self) -> tuple:
+        """Return what determines the encoded output, encoders with equal keys share an encode."""
+        return (tuple(sorted(self.save_options().items())), self.max_bytes, self.min_quality)
+
+    def fingerprint(self) -> str:
+        """Return the key as a string, identifying the estimate of these settings between runs."""
+        return f"{self.describe()}, minQuality={self.min_quality}"
+
+    def estimate(self) -> dict:
+        """Return the quality and scale chosen for the previous image, empty before the first."""
+        with self.history_lock:
+            return dict(self.history)
+
+    def restore(self, estimate: dict) -> None:
+        """Start the byte budget search from the estimate of a previous run."""
+        with self.history_lock:
+            self.history = {key: estimate[key] for key in ("quality", "scale") if key in estimate}
+
+    @property
+    def extension(self) -> str:
+        return self.FORMATS[self.format][1]
+
+    @property
+    def lossy(self) -> bool:
+        return (self.format == "jpeg") or ((self.format == "webp") and not self.lossless)
+
+    def save_options(self) -> dict:
+        """Return the keyword arguments passed to Image.save for these settings."""
+        options = {"format": self.FORMATS[self.format][0]}
+
+        if self.format == "jpeg":
+            options.update(quality=self.quality, optimize=self.optimize, progressive=self.progressive)
+            if self.subsampling is not None:
+                # Pillow accepts "4:4:4", "4:2:2" and "4:2:0"
+                options["subsampling"] = self.subsampling
+        elif self.format == "webp":
+            options.update(quality=self.quality, lossless=self.lossless, method=self.method)
+        elif self.format == "png":
+            options.update(optimize=self.optimize, compress_level=self.compress_level)
+        return options
+
+    def describe(self) -> str:
+        """Return a short human-readable summary of the encoder settings."""
+        summary = ", ".join(f"{key}={value}" for key, value in self.save_options().items())
+        if self.max_bytes is not None:
+            summary = f"{summary}, maxBytes={self.max_bytes}"
+        return summary
+
+    def encode(self, image: Image.Image) -> bytes:
+        """Return the provided image encoded with these settings, within the byte budget if set."""
+        return self.encode_reporting(image)[0]
+
+    def encode_reporting(self, image: Image.Image) -> tuple:
+        """
+        Return the provided image encoded with these settings along with the quality, scale,
+        size and trial count chosen to fit the byte budget, None when there is no budget.
+        """
+        if self.max_bytes is not None:
+            return self.encode_within_budget(image)
+        return self.encode_with(image), None
+
+    def encode_with(self, image: Image.Image, quality: int = None, scale: float = 1.0) -> bytes:
+        """Return the provided image encoded with these settings at the given quality and scale."""
+        if (image.mode != "RGB") and (self.format == "jpeg"):
+            image = image.convert("RGB")
+        if scale < 1.0:
+            image = image.resize((max(int(image.width * scale), 1), max(int(image.height * scale), 1)), Image.LANCZOS)
+
+        options = self.save_options()
+        if (quality is not None) and ("quality" in options):
+            options["quality"] = quality
+
+        buffer = io.BytesIO()
+        image.save(buffer, **options)
+        return buffer.getvalue()
+
+    def encode_within_budget(self, image: Image.Image) -> tuple:
+        """
+        Return the provided image encoded at the highest quality, then the largest scale,
+        which fits within max_bytes, and the choice made. The quality chosen for the previous
+        image is tried first, so consecutive Item Shops of similar size usually need only two
+        trial encodes.
+        """
+        history = self.estimate()
+
+        trials = 0
+        best = None
+        data = None
+        quality = None
+
+        def attempt(quality: int, scale: float) -> bytes:
+            nonlocal trials
+            trials += 1
+            return self.encode_with(image, quality, scale)
+
+        if self.lossy:
+            low, high = self.min_quality, self.quality
+            if history.get("scale", 1.0) < 1.0:
+                # The previous image had to be downscaled, so start from the lowest quality
+                guess = low
+            else:
+                guess = min(max(history.get("quality", high), low), high)
+
+            # Binary search for the highest quality which fits, probing the neighbour
+            # of the estimate first as it is the most likely answer
+            neighbour = True
+            while low <= high:
+                data = attempt(guess, 1.0)
+                if len(data) <= self.max_bytes:
+                    best = (guess, 1.0, data)
+                    low = guess + 1
+                    guess = (guess + 1) if neighbour else ((low + high) // 2)
+                else:
+                    high = guess - 1
+                    guess = (guess - 1) if neighbour else ((low + high) // 2)
+                neighbour = False
+            quality = self.min_quality
+        else:
+            data = attempt(None, 1.0)
+            if len(data) <= self.max_bytes:
+                best = (None, 1.0, data)
+
+        scale = 1.0
+        for _ in range(self.MAX_SCALE_TRIALS):
+            if best is not None:
+                break
+            if (scale == 1.0) and (history.get("scale", 1.0) < 1.0):
+                scale = history["scale"]
+            else:
+                # Encoded size scales roughly with the pixel count
+                scale = max(scale * math.sqrt(self.max_bytes / len(data)) * 0.97, self.MIN_SCALE)
+            data = attempt(quality, scale)
+            if len(data) <= self.max_bytes:
+                best = (quality, scale, data)
+            elif scale == self.MIN_SCALE:
+                break
+
+        if best is None:
+            log.warning(f"ImageEncoder => Unable to fit {self.max_bytes:,} bytes, smallest encode was {len(data):,} bytes")
+            best = (quality, scale, data)
+
+        with self.history_lock:
+            self.history = {"quality": best[0], "scale": best[1]}
+        return best[2], {"quality": best[0], "scale": round(best[1], 3), "bytes": len(best[2]), "trials": trials}
+
+
+class MediaBuffer(io.BytesIO):
+    """In-memory file object with the name and mode publishers expect from an opened file."""
+
+    def __init__(self, data: bytes, name: str) -> None:
+        super().__init__(data)
+        self.name = name
+        self.mode = "rb"
+
+
+class RenderedImage:
+    """An encoded Item Shop image held in memory, along with its metadata."""
+
+    name: str
+    page: int
+    data: bytes
+    format: str
+    extension: str
+    width: int
+    height: int
+    hash: str
+
+    def __init__(self, name: str, data: bytes, encoder: ImageEncoder, page: int = None) -> None:
+        self.name = name
+        self.page = page
+        self.data = data
+        self.format = encoder.format
+        self.extension = encoder.extension
+        # Only the header is parsed to read the dimensions
+        self.width, self.height = Image.open(io.BytesIO(data)).size
+        self.hash = hashlib.sha256(data).hexdigest()
+
+    def __repr__(self) -> str:
+        return f"RenderedImage({self.filename}, {self.width}x{self.height}, {self.size:,} bytes, {self.hash[:12]})"
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+    @property
+    def filename(self) -> str:
+        filename = "itemshop"
+        if self.name != "file":
+            filename = f"{filename}-{self.name}"
+        if self.page is not None:
+            filename = f"{filename}-{self.page}"
+        return f"{filename}.{self.extension}"
+
+    def open(self) -> MediaBuffer:
+        """Return a new file object reading the encoded image."""
+        return MediaBuffer(self.data, self.filename)
+
+    def save(self, filename: str = None) -> str:
+        """
+        Write the encoded image to filename, defaulting to its own filename, through a
+        temporary file which is atomically renamed so readers never see a partial image.
+        """
+        filename = filename or self.filename
+        write_atomic(filename, self.data)
+        return filename
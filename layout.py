@@ -0,0 +1,150 @@
+import math
+
+
+class SectionLayout:
+    """Column count, origin and card coordinates of a single Item Shop section."""
+
+    columns: int
+    rows: int
+    x: int
+    positions: list
+
+    def __init__(self, entries: int, columns: int, x: int, top: int) -> None:
+        self.columns = columns
+        self.rows = math.ceil(entries / columns)
+        self.x = x
+        self.positions = [
+            (
+                (x + ((index % columns) * ShopLayout.CELL_WIDTH)),
+                (top + ((index // columns) * ShopLayout.CELL_HEIGHT)),
+            )
+            for index in range(entries)
+        ]
+
+    @property
+    def width(self) -> int:
+        return (self.columns * ShopLayout.CELL_WIDTH) - ShopLayout.CARD_GAP
+
+
+class ShopLayout:
+    """
+    Grid layout of an Item Shop image with the sections placed side by side.
+
+    The layout only depends on the number of entries in each section, so it is computed
+    once per Item Shop and contains no pixel work.
+    """
+
+    CARD_WIDTH = 310
+    CARD_HEIGHT = 510
+    CARD_GAP = 20
+    CELL_WIDTH = CARD_WIDTH + CARD_GAP
+    CELL_HEIGHT = CARD_HEIGHT + CARD_GAP
+
+    MARGIN = 20
+    SECTION_GAP = 50
+    HEADER_HEIGHT = 350
+    # Narrowest image which still fits the title and date
+    MIN_WIDTH = 1010
+    # Fraction of a page a boundary may move by to keep a section whole
+    SPLIT_MARGIN = 0.25
+
+    width: int
+    height: int
+    sections: list
+
+    def __init__(self, entries: list, columns: list) -> None:
+        self.sections = []
+
+        grid_width = sum((section_columns * self.CELL_WIDTH) - self.CARD_GAP for section_columns in columns)
+        grid_width += self.SECTION_GAP * (len(columns) - 1)
+        self.width = max(grid_width + (self.MARGIN * 2), self.MIN_WIDTH)
+
+        # Center the sections when the image is wider than them
+        x = (self.width - grid_width) // 2
+        for count, section_columns in zip(entries, columns):
+            section = SectionLayout(count, section_columns, x, self.HEADER_HEIGHT)
+            self.sections.append(section)
+            x += section.width + self.SECTION_GAP
+
+        self.height = self.HEADER_HEIGHT + (max(section.rows for section in self.sections) * self.CELL_HEIGHT)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ShopLayout) and (self.size == other.size) and (self.positions == other.positions)
+
+    @property
+    def size(self) -> tuple:
+        return (self.width, self.height)
+
+    @property
+    def rows(self) -> int:
+        return max(section.rows for section in self.sections)
+
+    @property
+    def positions(self) -> list:
+        """Return the coordinates of every card, section by section."""
+        return [position for section in self.sections for position in section.positions]
+
+    @classmethod
+    def compute(cls, entries: list, aspect_ratio: float = 1.0, min_columns: int = 3):
+        """
+        Return the layout for sections with the provided number of entries whose
+        width to height ratio is closest to aspect_ratio.
+
+        Every candidate row count is tried, giving each section the fewest columns
+        which fit its entries in that many rows.
+        """
+        if (len(entries) == 0) or (min(entries) <= 0):
+            raise ValueError("Every section of the layout requires at least one entry")
+
+        best = None
+        best_score = None
+        candidates = set()
+        for rows in range(1, max(entries) + 1):
+            columns = tuple(max(math.ceil(count / rows), min(min_columns, count)) for count in entries)
+            if columns in candidates:
+                continue
+            candidates.add(columns)
+
+            layout = cls(entries, columns)
+            score = abs(math.log((layout.width / layout.height) / aspect_ratio))
+            if (best_score is None) or (score < best_score):
+                best, best_score = layout, score
+        return best
+
+    @classmethod
+    def paginate(cls, entries: list, pages: int) -> list:
+        """
+        Partition sections with the provided number of entries into at most `pages`
+        pages holding about the same number of cards, each a list of (section index,
+        start, end) entry slices in display order.
+
+        Page boundaries fall at equal card counts, splitting sections where needed. A
+        boundary moves to the nearest section edge when that is within SPLIT_MARGIN of
+        a page, so small sections are kept whole rather than split into slivers.
+        """
+        total = sum(entries)
+        pages = max(1, min(pages, total))
+        target = total / pages
+
+        edges = [0]
+        for count in entries:
+            edges.append(edges[-1] + count)
+
+        bounds = [0]
+        for page in range(1, pages):
+            bound = round(page * target)
+            nearest = min(edges, key=lambda edge: abs(edge - bound))
+            if abs(nearest - bound) <= target * cls.SPLIT_MARGIN:
+                bound = nearest
+            # Every page keeps at least one card
+            bounds.append(min(max(bound, bounds[-1] + 1), total - (pages - page)))
+        bounds.append(total)
+
+        result = []
+        for start, end in zip(bounds, bounds[1:]):
+            result.append([
+                (index, max(start, edges[index]) - edges[index], min(end, edges[index + 1]) - edges[index])
+                for index in range(len(entries))
+                if max(start, edges[index]) < min(end, edges[index + 1])
+            ])
+        return result
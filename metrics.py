@@ -0,0 +1,241 @@
+import json
+import math
+import bisect
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import ContextDecorator
+
+log = logging.getLogger("metrics")
+
+
+class timed(ContextDecorator):
+    """
+    Record the duration of a block, or of every call when used as a decorator, under the
+    provided stage name in the shared `timings`.
+
+        with timed("fetch"):
+            ...
+
+        @timed("encode")
+        def encode(...):
+    """
+
+    def __init__(self, stage: str, recorder: "Timings" = None) -> None:
+        self.stage = stage
+        self.recorder = recorder
+
+    def _recreate_cm(self) -> "timed":
+        # Every decorated call gets its own start time, calls may overlap across threads
+        return timed(self.stage, self.recorder)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception) -> bool:
+        (self.recorder or timings).record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Timings:
+    """
+    Durations recorded per stage, summarized as p50, p95 and max once per Item Shop rotation.
+
+    Recording only appends to a bounded deque, so instrumenting hot paths costs next to nothing.
+    """
+
+    # Samples kept per stage, enough for a day of polls
+    MAX_SAMPLES = 10000
+
+    samples: dict
+    listeners: list
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.listeners = []
+
+    def record(self, stage: str, duration: float) -> None:
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.MAX_SAMPLES)
+            samples.append(duration)
+
+        for listener in self.listeners:
+            listener(stage, duration)
+
+    def listen(self, listener) -> None:
+        """Call listener(stage, duration) for every recorded duration."""
+        self.listeners.append(listener)
+
+    @staticmethod
+    def percentile(ordered: list, percent: float) -> float:
+        """Return the nearest-rank percentile of the provided sorted samples."""
+        return ordered[max(math.ceil((percent / 100) * len(ordered)) - 1, 0)]
+
+    def summary(self) -> dict:
+        """Return the count, total, p50, p95 and max in seconds of every stage."""
+        with self.lock:
+            stages = {stage: sorted(samples) for stage, samples in self.samples.items() if len(samples) > 0}
+
+        return {
+            stage: {
+                "count": len(ordered),
+                "total": round(sum(ordered), 6),
+                "p50": round(self.percentile(ordered, 50), 6),
+                "p95": round(self.percentile(ordered, 95), 6),
+                "max": round(ordered[-1], 6),
+            }
+            for stage, ordered in sorted(stages.items())
+        }
+
+    def flush(self, **fields) -> dict:
+        """Log the summary as a single JSON line along with the provided fields, then start over."""
+        summary = {"event": "rotation", **fields, "stages": self.summary()}
+        with self.lock:
+            self.samples = {}
+
+        log.info(json.dumps(summary, separators=(",", ":")))
+        return summary
+
+
+class Counter:
+    """Monotonically increasing count, optionally split by label values."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Histogram:
+    """Observed values counted into cumulative buckets, optionally split by label values."""
+
+    kind = "histogram"
+
+    # Seconds, from a cached card up to a slow publish
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, name: str, help: str, buckets: tuple = BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket and the +Inf bucket, followed by the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self) -> list:
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+
+        samples = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                samples.append((f"{self.name}_bucket", key + (("le", le),), cumulative))
+            samples.append((f"{self.name}_sum", key, counts[-1]))
+            samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+
+class Registry:
+    """Counters and histograms rendered together in the Prometheus text format."""
+
+    def __init__(self) -> None:
+        self.metrics = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: tuple = Histogram.BUCKETS) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    @staticmethod
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += "{" + ",".join(f'{label}="{self.escape(text)}"' for label, text in labels) + "}"
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str = "127.0.0.1", port: int = 9464):
+        """Serve the metrics at /metrics from a daemon thread, return the server."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args) -> None:
+                log.debug(f"Metrics => {self.address_string()} {format % args}")
+
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                data = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        log.info(f"Metrics => Serving at http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+# Shared by every module, flushed by Athena once per rotation
+timings = Timings()
+
+# Always recorded, they cost a dictionary update each, served only when enabled
+registry = Registry()
+stage_seconds = registry.histogram("athena_stage_duration_seconds", "Duration of each timed stage, fetch is the Item Shop poll.")
+polls = registry.counter("athena_polls_total", "Item Shop polls by HTTP status code, error when the request failed.")
+hash_changes = registry.counter("athena_hash_changes_total", "Item Shop updates detected.")
+card_lookups = registry.counter("athena_card_cache_total", "Card lookups by result, hit or miss.")
+download_bytes = registry.counter("athena_download_bytes_total", "Bytes of icons and images downloaded.")
+publishes = registry.counter("athena_publishes_total", "Publish attempts by destination and outcome, success, retry or failed.")
+rotation_publish_seconds = registry.histogram("athena_rotation_publish_seconds", "Seconds from the Item Shop rotation, as dated by the API or else when it was detected, until the first attempt to publish it finished at every destination.")
+
+timings.listen(lambda stage, duration: stage_seconds.observe(duration, stage=stage))
@@ -0,0 +1,123 @@
+import time
+import queue
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    Pipeline stage with a bounded input queue drained by its own worker threads.
+
+    Every item taken from the queue is passed to function, and its result, unless None,
+    is put on the next stage. A full queue blocks the previous stage, so a slow stage
+    applies backpressure instead of buffering without limit.
+    """
+
+    name: str
+    workers: int
+    queue: queue.Queue
+    next: "Stage" = None
+
+    def __init__(self, name: str, function, workers: int = 1, capacity: int = 4, failed=None) -> None:
+        self.name = name
+        self.function = function
+        self.failed = failed
+        self.workers = max(workers, 1)
+        self.queue = queue.Queue(maxsize=max(capacity, 1))
+        self.threads = []
+
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = 0.0
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item, block: bool = True) -> bool:
+        """Queue the provided item, return False if the queue is full and block is False."""
+        try:
+            self.queue.put(item, block=block)
+            return True
+        except queue.Full:
+            return False
+
+    def work(self) -> None:
+        while True:
+            item = self.queue.get()
+            with self.lock:
+                self.busy += 1
+
+            start = time.perf_counter()
+            try:
+                result = self.function(item)
+            except Exception as error:
+                result = None
+                with self.lock:
+                    self.errors += 1
+                log.error(f"Pipeline => {self.name} => {error}")
+                if self.failed is not None:
+                    self.failed(item)
+
+            latency = time.perf_counter() - start
+            with self.lock:
+                self.busy -= 1
+                self.processed += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.last_latency = latency
+
+            if (result is not None) and (self.next is not None):
+                self.next.put(result)
+            self.queue.task_done()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "stage": self.name,
+                "workers": self.workers,
+                "depth": self.queue.qsize(),
+                "busy": self.busy,
+                "processed": self.processed,
+                "errors": self.errors,
+                "lastLatency": round(self.last_latency, 3),
+                "averageLatency": round(self.total_latency / self.processed, 3) if self.processed else 0.0,
+                "maxLatency": round(self.max_latency, 3),
+            }
+
+
+class Pipeline:
+    """Stages connected in order, each feeding its results into the next."""
+
+    stages: dict
+
+    def __init__(self, stages: list) -> None:
+        self.stages = {stage.name: stage for stage in stages}
+        for stage, following in zip(stages, stages[1:]):
+            stage.next = following
+
+    def __getitem__(self, name: str) -> Stage:
+        return self.stages[name]
+
+    def start(self) -> None:
+        for stage in self.stages.values():
+            stage.start()
+
+    def stats(self) -> list:
+        return [stage.stats() for stage in self.stages.values()]
+
+    def log_stats(self) -> None:
+        for stats in self.stats():
+            log.info(
+                f"Pipeline => {stats['stage']:<8} depth {stats['depth']} busy {stats['busy']}/{stats['workers']} "
+                f"processed {stats['processed']} errors {stats['errors']} "
+                f"latency last {stats['lastLatency']}s avg {stats['averageLatency']}s max {stats['maxLatency']}s"
+            )
@@ -0,0 +1,481 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import requests
+import twitter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from encoders import ImageEncoder
+from utilty import write_atomic
+
+log = logging.getLogger(__name__)
+
+try:
+    import boto3
+    from botocore.config import Config as BotoConfig
+except ImportError:
+    boto3 = None
+
+
+class ImageArchive:
+    """
+    Output sink writing every render as content-hash named files, which never change and
+    can be cached forever, plus a `latest.json` manifest which is the only file revalidated.
+    """
+
+    MANIFEST = "latest.json"
+    # Only files named like archived images are ever removed, <sha256>.<extension>
+    ARCHIVED = re.compile(
+        r"[0-9a-f]{64}\.(?:" + "|".join(re.escape(extension) for _, extension in ImageEncoder.FORMATS.values()) + r")"
+    )
+
+    directory: str
+    retain: int
+
+    def __init__(self, directory: str = "archive", retain: int = 30) -> None:
+        self.directory = directory
+        self.retain = max(retain, 1)
+        # Renders and their corrections may be archived concurrently, the manifest is read, rewritten and pruned as one
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def load_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, self.MANIFEST), "r", encoding="utf-8") as data:
+                return json.load(data)
+        except FileNotFoundError:
+            pass
+        except Exception as error:
+            log.error(f"ImageArchive => Failed to read {self.MANIFEST} => {error}")
+        return {"history": []}
+
+    def publish(self, pages: list) -> dict:
+        """
+        Archive the encoded images of the provided pages, swap the manifest to point at them
+        and remove the files no longer referenced by the retained renders.
+
+        Return the new manifest.
+        """
+        with self.lock:
+            render = {"createdAt": datetime.now(timezone.utc).isoformat(timespec="seconds"), "pages": []}
+            for images in pages:
+                entries = {}
+                for name, image in images.items():
+                    filename = f"{image.hash}.{image.extension}"
+                    path = os.path.join(self.directory, filename)
+                    # Content-hash names mean an existing file already holds these exact bytes
+                    if not os.path.exists(path):
+                        write_atomic(path, image.data)
+
+                    entries[name] = {
+                        "path": filename,
+                        "width": image.width,
+                        "height": image.height,
+                        "bytes": image.size,
+                        "hash": image.hash,
+                        "format": image.format,
+                    }
+                render["pages"].append(entries)
+
+            previous = self.load_manifest()
+            history = ([render] + previous.get("history", []))[:self.retain]
+            manifest = {**render, "history": history}
+            write_atomic(os.path.join(self.directory, self.MANIFEST), json.dumps(manifest, indent=4).encode("utf-8"))
+
+            self.prune(history)
+            log.info(f"ImageArchive => Archived {len(pages)} pages, manifest points at {render['pages'][0]['file']['path']}")
+            return manifest
+
+    def prune(self, history: list) -> None:
+        """Remove archived images which none of the provided renders reference, leaving any other file alone."""
+        referenced = {
+            image["path"]
+            for render in history
+            for page in render["pages"]
+            for image in page.values()
+        }
+        for filename in os.listdir(self.directory):
+            if (filename in referenced) or not self.ARCHIVED.fullmatch(filename):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except Exception as error:
+                log.error(f"ImageArchive => Failed to remove {filename} => {error}")
+
+
+class Publisher:
+    """
+    Destination the encoded Item Shop images are published to.
+
+    Subclasses implement `publish`, and optionally `connect`, called once at startup, and
+    `prepare`, called as soon as the images are encoded so work such as uploads can begin
+    before the publish job runs. Each destination publishes from its own publish queue job,
+    so it is retried independently, and applies its own `timeout` to network requests.
+    """
+
+    name: str = None
+    timeout: float
+
+    def __init__(self, support_a_creator: str = None, timeout: float = 30) -> None:
+        self.support_a_creator = support_a_creator
+        self.timeout = timeout
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.name})"
+
+    def connect(self) -> bool:
+        """Prepare the destination for publishing, return True if it is ready."""
+        return True
+
+    def prepare(self, images: list) -> None:
+        """Start any work which only depends on the provided encoded images."""
+
+    def body(self, date: str) -> str:
+        body = f"Battle Royale - #Fortnite Item Shop | {date}"
+
+        if self.support_a_creator is not None:
+            body = f"{body}\n\nUse code: {self.support_a_creator} in the item shop!"
+        return body
+
+    def publish(self, date: str, images: list) -> bool:
+        """Publish the provided encoded images, one per page, return True on success."""
+        raise NotImplementedError
+
+
+class TwitterPublisher(Publisher):
+    """
+    Twitter client created and verified once, then reused for every Tweet. The credentials
+    are only verified again after Twitter rejects them.
+
+    Images are uploaded in chunks with the INIT, APPEND and FINALIZE media commands. Each
+    chunk is retried on its own and the progress of every upload is kept, so a failed upload
+    resumes from the last chunk Twitter received rather than starting over.
+    """
+
+    # Twitter error codes meaning the credentials were rejected
+    AUTH_ERRORS = {32, 64, 89, 99, 135, 215, 326}
+    # Concurrent uploads, one per page at most
+    UPLOAD_WORKERS = 4
+
+    name = "twitter"
+    api: twitter.Api = None
+    verified: bool = False
+    uploads: dict
+    futures: dict
+
+    def __init__(
+        self,
+        api_key: str,
+        api_secret: str,
+        access_token: str,
+        access_secret: str,
+        support_a_creator: str = None,
+        chunk_size: int = 1048576,
+        chunk_retries: int = 3,
+        base_url: str = None,
+        upload_url: str = None,
+        timeout: float = 30,
+    ) -> None:
+        super().__init__(support_a_creator, timeout)
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.access_token = access_token
+        self.access_secret = access_secret
+        self.chunk_size = max(chunk_size, 1)
+        self.chunk_retries = max(chunk_retries, 1)
+        # Another server implementing the same endpoints, such as the stand-in in standin.py
+        self.urls = {key: url for key, url in (("base_url", base_url), ("upload_url", upload_url)) if url}
+        self.lock = threading.Lock()
+
+        # Progress of each upload by image hash, kept until the image is Tweeted
+        self.uploads = {}
+        self.futures = {}
+        self.uploads_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.UPLOAD_WORKERS, thread_name_prefix="upload")
+
+    def connect(self) -> bool:
+        """Create the client if needed and verify the credentials, return True if they are valid."""
+        with self.lock:
+            if self.verified:
+                return True
+
+            try:
+                if self.api is None:
+                    self.api = twitter.Api(
+                        consumer_key=self.api_key,
+                        consumer_secret=self.api_secret,
+                        access_token_key=self.access_token,
+                        access_token_secret=self.access_secret,
+                        timeout=self.timeout,
+                        **self.urls,
+                    )
+
+                self.api.VerifyCredentials()
+                self.verified = True
+                log.info("TwitterPublisher => Authenticated")
+            except Exception as e:
+                log.critical(f"Failed to authenticate with Twitter, {e}")
+            return self.verified
+
+    @classmethod
+    def is_auth_error(cls, error: Exception) -> bool:
+        messages = getattr(error, "message", None)
+        if not isinstance(messages, list):
+            return False
+        return any(isinstance(message, dict) and (message.get("code") in cls.AUTH_ERRORS) for message in messages)
+
+    def prepare(self, images: list) -> None:
+        # Upload while the job waits on the publish queue, the Tweet then only attaches the media
+        for image in images:
+            self.upload_async(image)
+
+    def media_command(self, parameters: dict) -> dict:
+        """Send a media upload command, return the parsed response or None if it was empty."""
+        response = self.api._RequestUrl(f"{self.api.upload_url}/media/upload.json", "POST", data=parameters)
+        content = response.content.decode("utf-8")
+        if content:
+            return self.api._ParseAndCheckTwitter(content)
+        if response.status_code >= 400:
+            raise twitter.TwitterError({"message": f"Media upload {parameters['command']} failed with HTTP {response.status_code}"})
+        return None
+
+    def upload_async(self, image):
+        """Start uploading the provided encoded image, return the future of its media ID."""
+        with self.uploads_lock:
+            future = self.futures.get(image.hash)
+            # A failed upload is started again, resuming from its last chunk
+            if (future is None) or (future.done() and (future.exception() is not None)):
+                future = self.executor.submit(self.upload, image)
+                self.futures[image.hash] = future
+            return future
+
+    def upload(self, image) -> int:
+        """Upload the provided encoded image in chunks, return its media ID."""
+        if not self.connect():
+            raise twitter.TwitterError({"message": "Not authenticated"})
+
+        with self.uploads_lock:
+            upload = self.uploads.get(image.hash)
+        if (upload is None) or (upload["expires"] <= time.time()):
+            data = self.media_command({"command": "INIT", "media_type": f"image/{image.format}", "total_bytes": image.size})
+            upload = {
+                "mediaId": data["media_id"],
+                "segment": 0,
+                "finalized": False,
+                "expires": time.time() + data.get("expires_after_secs", 86400),
+            }
+            with self.uploads_lock:
+                self.uploads[image.hash] = upload
+        elif upload["segment"] > 0:
+            log.info(f"TwitterPublisher => Resuming upload of {image.filename} from chunk {upload['segment']}")
+
+        segments = max(-(-image.size // self.chunk_size), 1)
+        while upload["segment"] < segments:
+            start = upload["segment"] * self.chunk_size
+            chunk = image.data[start:start + self.chunk_size]
+
+            for attempt in range(1, self.chunk_retries + 1):
+                try:
+                    self.media_command({
+                        "command": "APPEND",
+                        "media_id": str(upload["mediaId"]),
+                        "segment_index": str(upload["segment"]),
+                        "media": chunk,
+                    })
+                    break
+                except Exception as error:
+                    if attempt >= self.chunk_retries:
+                        raise
+                    log.warning(f"TwitterPublisher => Chunk {upload['segment']} of {image.filename} failed, retrying => {error}")
+                    time.sleep(attempt)
+            upload["segment"] += 1
+
+        if not upload["finalized"]:
+            self.media_command({"command": "FINALIZE", "media_id": upload["mediaId"]})
+            upload["finalized"] = True
+        return upload["mediaId"]
+
+    def forget(self, images: list) -> None:
+        with self.uploads_lock:
+            for image in images:
+                self.uploads.pop(image.hash, None)
+                self.futures.pop(image.hash, None)
+
+            # Uploads which were never Tweeted can no longer be attached once expired
+            now = time.time()
+            for key in [key for key, upload in self.uploads.items() if upload["expires"] <= now]:
+                self.uploads.pop(key, None)
+                self.futures.pop(key, None)
+
+    def publish(self, date: str, images: list) -> bool:
+        """
+        Tweet the provided encoded `Item Shop` images, one per page, reusing uploads which
+        already started when the images were encoded.
+
+        Return True if the Tweet was sent.
+        """
+        if not self.connect():
+            return False
+
+        start = time.perf_counter()
+        try:
+            media = [future.result() for future in [self.upload_async(image) for image in images]]
+            uploaded = time.perf_counter()
+            log.info(f"TwitterPublisher => Media Uploaded in => {(uploaded - start):.3f}")
+
+            self.api.PostUpdate(self.body(date), media=media)
+            self.forget(images)
+
+            log.info(f"Tweeted Item Shop => {images}")
+            log.info(f"TwitterPublisher => Status Posted in => {(time.perf_counter() - uploaded):.3f}")
+            return True
+        except Exception as e:
+            if self.is_auth_error(e):
+                # Verify again before the next attempt
+                self.verified = False
+            log.critical(f"Failed to Tweet Item Shop, {e}")
+        return False
+
+
+class WebhookPublisher(Publisher):
+    """Posts the images as attachments of a Discord-style webhook message."""
+
+    name = "webhook"
+
+    def __init__(self, url: str, username: str = None, support_a_creator: str = None, timeout: float = 30) -> None:
+        super().__init__(support_a_creator, timeout)
+        self.url = url
+        self.username = username
+        self.session = requests.Session()
+
+    def publish(self, date: str, images: list) -> bool:
+        payload = {"content": self.body(date)}
+        if self.username is not None:
+            payload["username"] = self.username
+
+        files = {
+            f"files[{index}]": (image.filename, image.data, f"image/{image.format}")
+            for index, image in enumerate(images)
+        }
+
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.url, data={"payload_json": json.dumps(payload)}, files=files, timeout=self.timeout)
+            if not response.ok:
+                log.error(f"WebhookPublisher => Webhook responded with HTTP {response.status_code} => {response.text[:200]}")
+                return False
+        except Exception as error:
+            log.error(f"WebhookPublisher => Failed to post to the webhook => {error}")
+            return False
+
+        log.info(f"WebhookPublisher => Posted {len(images)} images in => {(time.perf_counter() - start):.3f}")
+        return True
+
+
+class FilesystemPublisher(Publisher):
+    """Writes the images into a directory, such as one served by a web server, replacing the previous ones."""
+
+    name = "filesystem"
+
+    def __init__(self, directory: str = "published", support_a_creator: str = None, timeout: float = 30) -> None:
+        super().__init__(support_a_creator, timeout)
+        self.directory = directory
+
+    def connect(self) -> bool:
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            return True
+        except Exception as error:
+            log.error(f"FilesystemPublisher => Failed to create {self.directory} => {error}")
+        return False
+
+    def publish(self, date: str, images: list) -> bool:
+        if not self.connect():
+            return False
+
+        try:
+            for image in images:
+                write_atomic(os.path.join(self.directory, image.filename), image.data)
+        except Exception as error:
+            log.error(f"FilesystemPublisher => Failed to write to {self.directory} => {error}")
+            return False
+
+        log.info(f"FilesystemPublisher => Wrote {len(images)} images to {self.directory}")
+        return True
+
+
+class S3Publisher(Publisher):
+    """
+    Uploads the images to a bucket of an S3-compatible object store.
+
+    boto3 is optional, check `S3Publisher.available()` before use.
+    """
+
+    name = "s3"
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: str = None,
+        region: str = None,
+        access_key: str = None,
+        secret_key: str = None,
+        support_a_creator: str = None,
+        timeout: float = 30,
+    ) -> None:
+        super().__init__(support_a_creator, timeout)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.client = None
+
+    @staticmethod
+    def available() -> bool:
+        return boto3 is not None
+
+    def connect(self) -> bool:
+        if self.client is not None:
+            return True
+
+        try:
+            self.client = boto3.client(
+                "s3",
+                endpoint_url=self.endpoint_url,
+                region_name=self.region,
+                aws_access_key_id=self.access_key,
+                aws_secret_access_key=self.secret_key,
+                config=BotoConfig(connect_timeout=self.timeout, read_timeout=self.timeout, retries={"max_attempts": 2}),
+            )
+            return True
+        except Exception as error:
+            log.error(f"S3Publisher => Failed to create the S3 client => {error}")
+        return False
+
+    def publish(self, date: str, images: list) -> bool:
+        if not self.connect():
+            return False
+
+        start = time.perf_counter()
+        try:
+            for image in images:
+                self.client.put_object(
+                    Bucket=self.bucket,
+                    Key=f"{self.prefix}{image.filename}",
+                    Body=image.data,
+                    ContentType=f"image/{image.format}",
+                    # The names are reused by every Item Shop, so caches must revalidate them
+                    CacheControl="no-cache",
+                )
+        except Exception as error:
+            log.error(f"S3Publisher => Failed to upload to {self.bucket} => {error}")
+            return False
+
+        log.info(f"S3Publisher => Uploaded {len(images)} images to {self.bucket} in => {(time.perf_counter() - start):.3f}")
+        return True
@@ -0,0 +1,230 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from metrics import timed, publishes
+
+log = logging.getLogger(__name__)
+
+
+class PublishQueue:
+    """
+    Durable queue of publish jobs backed by SQLite, drained by a background worker.
+
+    Jobs are unique per Item Shop hash and destination, so an Item Shop is never queued
+    twice, failed jobs are retried with exponential backoff, and jobs interrupted by a
+    crash are resumed on restart. A job interrupted mid-publish is published again, as
+    the destination may not have received it.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shop_hash TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            date TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt REAL NOT NULL,
+            error TEXT,
+            created REAL NOT NULL,
+            UNIQUE (shop_hash, destination)
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            job_id INTEGER NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            page INTEGER,
+            format TEXT NOT NULL,
+            data BLOB NOT NULL
+        );
+    """
+
+    # Completed and failed jobs kept to deduplicate recent Item Shops
+    HISTORY = 100
+    # Jobs to publish now, including those left running by a process which stopped mid-publish
+    DUE = "SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running') AND next_attempt <= ?"
+
+    handlers: dict
+    in_flight: set
+
+    def __init__(self, filename: str = "publish-queue.db", max_attempts: int = 5, retry_delay: float = 30) -> None:
+        self.filename = filename
+        self.max_attempts = max(max_attempts, 1)
+        self.retry_delay = retry_delay
+        self.handlers = {}
+        # Destinations with a job being published, each publishes one job at a time
+        self.in_flight = set()
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA foreign_keys = ON")
+            self.connection.executescript(self.SCHEMA)
+            # Jobs still running belong to a previous process which stopped mid-publish
+            resumed = self.connection.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'").rowcount
+        if resumed > 0:
+            log.warning(f"PublishQueue => Resuming {resumed} interrupted jobs")
+
+    @classmethod
+    def has_due(cls, filename: str) -> bool:
+        """
+        Return True if the queue stored in filename holds jobs due to be published now,
+        reading it without creating it or resuming its jobs.
+        """
+        if not os.path.exists(filename):
+            return False
+        try:
+            connection = sqlite3.connect(filename)
+            try:
+                return connection.execute(cls.DUE, (time.time(),)).fetchone()[0] > 0
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            return False
+
+    def register(self, destination: str, handler) -> None:
+        """Publish jobs for destination with handler(date, images), which returns True on success."""
+        self.handlers[destination] = handler
+
+    def start(self) -> None:
+        threading.Thread(target=self.work, name="publisher", daemon=True).start()
+
+    def drain(self, poll: float = 0.1) -> None:
+        """Block until no job is being published or due now, jobs waiting to be retried are left queued."""
+        while True:
+            due = self.next_due()
+            if (len(self.busy()) == 0) and ((due is None) or (due > 0)):
+                return
+            time.sleep(poll)
+
+    def busy(self) -> list:
+        with self.lock:
+            return list(self.in_flight)
+
+    def enqueue(self, shop_hash: str, destination: str, date: str, images: list) -> bool:
+        """Queue the provided encoded images, return False if this Item Shop was already queued for destination."""
+        now = time.time()
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO jobs (shop_hash, destination, date, next_attempt, created) VALUES (?, ?, ?, ?, ?)",
+                (shop_hash, destination, date, now, now),
+            )
+            if cursor.rowcount == 0:
+                log.info(f"PublishQueue => {shop_hash} already queued for {destination}, skipping")
+                return False
+
+            self.connection.executemany(
+                "INSERT INTO images (job_id, position, name, page, format, data) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (cursor.lastrowid, position, image.name, image.page, image.format, image.data)
+                    for position, image in enumerate(images)
+                ],
+            )
+
+        self.wake.set()
+        return True
+
+    def pending(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+
+    def claim(self):
+        """Return the next due job of an idle destination marked as running, None if no job is due."""
+        with self.lock, self.connection:
+            busy = list(self.in_flight)
+            job = self.connection.execute(
+                "SELECT id, shop_hash, destination, date, attempts FROM jobs "
+                f"WHERE status = 'pending' AND next_attempt <= ? AND destination NOT IN ({', '.join('?' * len(busy))}) "
+                "ORDER BY id LIMIT 1",
+                (time.time(), *busy),
+            ).fetchone()
+            if job is None:
+                return None
+
+            self.in_flight.add(job[2])
+            self.connection.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (job[0],))
+            images = self.connection.execute(
+                "SELECT name, page, format, data FROM images WHERE job_id = ? ORDER BY position", (job[0],)
+            ).fetchall()
+        return job, images
+
+    def next_due(self) -> float:
+        """Return the seconds until the next pending job of an idle destination is due, None if there are none."""
+        with self.lock:
+            busy = list(self.in_flight)
+            due = self.connection.execute(
+                f"SELECT MIN(next_attempt) FROM jobs WHERE status = 'pending' AND destination NOT IN ({', '.join('?' * len(busy))})",
+                busy,
+            ).fetchone()[0]
+        return None if due is None else max(due - time.time(), 0)
+
+    def finish(self, job_id: int, succeeded: bool, attempts: int, error: str = None) -> None:
+        with self.lock, self.connection:
+            if succeeded:
+                self.connection.execute("UPDATE jobs SET status = 'done', attempts = ?, error = NULL WHERE id = ?", (attempts, job_id))
+            elif attempts >= self.max_attempts:
+                self.connection.execute("UPDATE jobs SET status = 'failed', attempts = ?, error = ? WHERE id = ?", (attempts, error, job_id))
+            else:
+                delay = self.retry_delay * (2 ** (attempts - 1))
+                self.connection.execute(
+                    "UPDATE jobs SET status = 'pending', attempts = ?, error = ?, next_attempt = ? WHERE id = ?",
+                    (attempts, error, time.time() + delay, job_id),
+                )
+
+            if succeeded or (attempts >= self.max_attempts):
+                # Finished jobs only need their row to deduplicate, not their images
+                self.connection.execute("DELETE FROM images WHERE job_id = ?", (job_id,))
+                self.connection.execute(
+                    "DELETE FROM jobs WHERE status IN ('done', 'failed') AND id NOT IN "
+                    "(SELECT id FROM jobs WHERE status IN ('done', 'failed') ORDER BY id DESC LIMIT ?)",
+                    (self.HISTORY,),
+                )
+
+    def work(self) -> None:
+        # Destinations publish concurrently, so a slow destination never delays the others
+        executor = ThreadPoolExecutor(max_workers=max(len(self.handlers), 1), thread_name_prefix="publisher")
+        while True:
+            claimed = self.claim()
+            if claimed is None:
+                due = self.next_due()
+                self.wake.wait(timeout=60 if due is None else due)
+                self.wake.clear()
+                continue
+
+            executor.submit(self.run, *claimed)
+
+    def run(self, job: tuple, rows: list) -> None:
+        from encoders import ImageEncoder, RenderedImage
+
+        job_id, shop_hash, destination, date, attempts = job
+        images = [RenderedImage(name, data, ImageEncoder({"format": format}), page) for name, page, format, data in rows]
+
+        attempts += 1
+        error = None
+        try:
+            handler = self.handlers[destination]
+            with timed(f"publish.{destination}"):
+                succeeded = handler(date, images)
+            if not succeeded:
+                error = "Publisher reported a failure"
+        except Exception as exception:
+            succeeded = False
+            error = str(exception)
+
+        self.finish(job_id, succeeded, attempts, error)
+        with self.lock:
+            self.in_flight.discard(destination)
+        self.wake.set()
+
+        outcome = "success" if succeeded else "failed" if attempts >= self.max_attempts else "retry"
+        publishes.inc(destination=destination, outcome=outcome)
+        if succeeded:
+            log.info(f"PublishQueue => Published {shop_hash} to {destination} after {attempts} attempts")
+        elif attempts >= self.max_attempts:
+            log.critical(f"PublishQueue => Giving up on {shop_hash} for {destination} after {attempts} attempts => {error}")
+        else:
+            log.error(f"PublishQueue => Attempt {attempts} publishing {shop_hash} to {destination} failed, retrying => {error}")
@@ -0,0 +1,205 @@
+import json
+import time
+import email
+import random
+import logging
+import argparse
+import threading
+import coloredlogs
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves the Twitter endpoints used by Athena from the state of its StandInServer."""
+
+    server: "StandInServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(f"StandIn => {self.address_string()} {format % args}")
+
+    def do_GET(self) -> None:
+        self.handle_request("GET")
+
+    def do_POST(self) -> None:
+        self.handle_request("POST")
+
+    def handle_request(self, verb: str) -> None:
+        url = urlparse(self.path)
+        parameters = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if verb == "POST":
+            parameters.update(self.read_form())
+
+        if self.server.latency > 0:
+            time.sleep(self.server.latency * random.uniform(1 - self.server.jitter, 1 + self.server.jitter))
+
+        if random.random() < self.server.error_rate:
+            self.server.count("errors")
+            return self.respond(503, {"errors": [{"code": 131, "message": "Internal error"}]})
+
+        routes = {
+            ("GET", "/1.1/account/verify_credentials.json"): self.server.verify_credentials,
+            ("POST", "/1.1/media/upload.json"): self.server.media_upload,
+            ("POST", "/1.1/statuses/update.json"): self.server.update_status,
+        }
+        route = routes.get((verb, url.path))
+        if route is None:
+            return self.respond(404, {"errors": [{"code": 34, "message": "Sorry, that page does not exist."}]})
+
+        status, body = route(parameters)
+        self.respond(status, body)
+
+    def read_form(self) -> dict:
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        contentType = self.headers.get("Content-Type", "")
+
+        if contentType.startswith("multipart/form-data"):
+            message = email.message_from_bytes(f"Content-Type: {contentType}\r\n\r\n".encode("utf-8") + data)
+            form = {}
+            for part in message.get_payload():
+                value = part.get_payload(decode=True)
+                name = part.get_param("name", header="content-disposition")
+                # Only the media is binary, the other fields are text
+                form[name] = value if name == "media" else value.decode("utf-8")
+            return form
+
+        return {key: values[0] for key, values in parse_qs(data.decode("utf-8")).items()}
+
+    def respond(self, status: int, body) -> None:
+        data = b"" if body is None else json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Twitter API, implementing the credential check, chunked media
+    upload and status update endpoints used by Athena.
+
+    Every request is delayed by `latency` seconds, varied by up to `jitter` of it, and fails
+    with a 503 at the provided `error_rate`, so publish throughput and retries can be
+    measured without real credentials.
+    """
+
+    daemon_threads = True
+
+    latency: float
+    jitter: float
+    error_rate: float
+    media: dict
+    statuses: list
+    counters: dict
+
+    def __init__(self, address: tuple = ("127.0.0.1", 0), latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0) -> None:
+        super().__init__(address, StandInHandler)
+        self.latency = max(latency, 0.0)
+        self.jitter = min(max(jitter, 0.0), 1.0)
+        self.error_rate = min(max(error_rate, 0.0), 1.0)
+
+        self.lock = threading.Lock()
+        self.media = {}
+        self.statuses = []
+        self.counters = {"errors": 0, "uploads": 0, "chunks": 0, "statuses": 0}
+        self.next_id = 1000
+
+    @property
+    def url(self) -> str:
+        """Return the base URL to configure as both `baseUrl` and `uploadUrl`."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/1.1"
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, name="standin", daemon=True).start()
+        log.info(f"StandIn => Serving the Twitter API at {self.url}")
+
+    def count(self, counter: str) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {**self.counters, "media": len(self.media)}
+
+    def identifier(self) -> int:
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def verify_credentials(self, parameters: dict) -> tuple:
+        return 200, {"id": 1, "id_str": "1", "screen_name": "athena", "name": "Athena"}
+
+    def media_upload(self, parameters: dict) -> tuple:
+        command = parameters.get("command")
+
+        if command == "INIT":
+            media_id = self.identifier()
+            with self.lock:
+                self.media[media_id] = {
+                    "type": parameters.get("media_type"),
+                    "total": int(parameters.get("total_bytes", 0)),
+                    "segments": {},
+                    "finalized": False,
+                }
+            self.count("uploads")
+            return 202, {"media_id": media_id, "media_id_string": str(media_id), "expires_after_secs": 86400}
+
+        media = self.media.get(int(parameters.get("media_id", 0)))
+        if media is None:
+            return 400, {"errors": [{"code": 324, "message": "Invalid media id."}]}
+
+        if command == "APPEND":
+            # Segments sent again after a retry replace the previous copy
+            media["segments"][int(parameters.get("segment_index", 0))] = parameters.get("media", b"")
+            self.count("chunks")
+            return 204, None
+
+        if command == "FINALIZE":
+            size = sum(len(segment) for segment in media["segments"].values())
+            if size != media["total"]:
+                return 400, {"errors": [{"code": 324, "message": f"File size mismatch, received {size} of {media['total']} bytes."}]}
+
+            media["finalized"] = True
+            return 201, {"media_id": int(parameters["media_id"]), "media_id_string": parameters["media_id"], "size": size}
+
+        return 400, {"errors": [{"code": 38, "message": "command parameter is missing."}]}
+
+    def update_status(self, parameters: dict) -> tuple:
+        media_ids = [int(media_id) for media_id in parameters.get("media_ids", "").split(",") if media_id]
+        for media_id in media_ids:
+            if not self.media.get(media_id, {}).get("finalized", False):
+                return 400, {"errors": [{"code": 324, "message": f"Media {media_id} is not finalized."}]}
+
+        status_id = self.identifier()
+        with self.lock:
+            self.statuses.append({"id": status_id, "text": parameters.get("status", ""), "media": media_ids})
+        self.count("statuses")
+        return 200, {"id": status_id, "id_str": str(status_id), "text": parameters.get("status", ""), "user": {"id": 1, "screen_name": "athena"}}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local stand-in for the Twitter API endpoints used by Athena")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds each request is delayed by")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Fraction the latency is varied by")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests failing with a 503")
+    arguments = parser.parse_args()
+
+    coloredlogs.install(level="INFO", fmt="[%(asctime)s] %(message)s", datefmt="%I:%M:%S")
+
+    server = StandInServer((arguments.host, arguments.port), arguments.latency, arguments.jitter, arguments.error_rate)
+    log.info(f"StandIn => Set twitter.baseUrl and twitter.uploadUrl to {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info(f"StandIn => Exiting => {server.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,66 @@
+from __future__ import annotations
+
+import os
+import sys
 import json
+import time
 import locale
 import logging
 import requests
-import coloredlogs
+import threading
 from datetime import date
-from PIL import Image, ImageFont
+from typing import TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from metrics import timed, polls, download_bytes
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 log = logging.getLogger(__name__)
-coloredlogs.install(level="INFO", fmt="[%(asctime)s] %(message)s", datefmt="%I:%M:%S")
+
+
+def setup_logging() -> None:
+    """Log to the terminal in color, or plainly when the output is not a terminal, such as under cron."""
+    if sys.stderr.isatty():
+        import coloredlogs
+
+        coloredlogs.install(level="INFO", fmt="[%(asctime)s] %(message)s", datefmt="%I:%M:%S")
+    else:
+        logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%I:%M:%S")
 
 
 class ConfgFile:
     language: str = "en"
     send_on_start: bool = False
+    state_file: str = "state.json"
+    stream_output: bool = False
+    save_file: bool = True
+
+    prefetch_workers: int = 8
+    render_workers: int = 1
+    encode_workers: int = 1
+    publish_workers: int = 1
+    queue_size: int = 4
+    warm_up: bool = True
+    render_deadline: float = 60
+    late_placeholder: bool = True
+    late_rerender: bool = True
+    late_replace: list = []
+    connect_timeout: float = 5
+    read_timeout: float = 15
+
+    publish_queue: str = "publish-queue.db"
+    publish_max_attempts: int = 5
+    publish_retry_delay: float = 30
+    publishers: dict = {}
+    encoders: dict = {"file": {"format": "jpeg", "quality": 85, "optimize": True}}
+    variants: list = []
+    aspect_ratio: float = 1.0
+    pages: int = 1
+
+    archive_enabled: bool = False
+    archive_directory: str = "archive"
+    archive_retain: int = 30
 
     api_key: str = None
     support_a_creator: str = None
@@ -22,10 +70,24 @@ class ConfgFile:
     twitter_api_secret: str = None
     twitter_access_token: str = None
     twitter_access_secret: str = None
+    twitter_chunk_size: int = 1048576
+    twitter_chunk_retries: int = 3
+    twitter_base_url: str = None
+    twitter_upload_url: str = None
+    twitter_timeout: float = 30
+
+    metrics_enabled: bool = False
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int = 9464
 
     def __init__(self) -> None:
         log.info("Configuration file => Initialized")
 
+    @property
+    def timeout(self) -> tuple:
+        """Return the (connect, read) timeout of every request."""
+        return (self.connect_timeout, self.read_timeout)
+
     def load_config(self) -> bool:
         """
         Set the configuration values specified in configuration.json
@@ -37,6 +99,65 @@ class ConfgFile:
 
             self.language = configuration.get("language", "en")
             self.send_on_start = configuration.get("sendOnStart", False)
+            self.state_file = configuration.get("stateFile", "state.json")
+            self.stream_output = configuration.get("output", {}).get("streaming", False)
+            self.save_file = configuration.get("output", {}).get("saveFile", True)
+            self.encoders = configuration.get("output", {}).get("encoders", self.encoders)
+            if "file" not in self.encoders:
+                self.encoders = {**self.encoders, "file": ConfgFile.encoders["file"]}
+            self.variants = configuration.get("output", {}).get("variants", [])
+            if self.stream_output:
+                # A streamed image is a single PNG shared by every destination
+                ignored = [
+                    name for name, settings in self.encoders.items()
+                    if (name != "file") or (settings.get("maxBytes") is not None) or (settings.get("format", "jpeg").lower() != "png")
+                ]
+                if len(ignored) > 0:
+                    log.warning(
+                        f"Configuration file => Streaming ignores output.encoders {', '.join(ignored)}, "
+                        "every destination receives the streamed PNG without a byte budget"
+                    )
+            self.aspect_ratio = configuration.get("layout", {}).get("aspectRatio", 1.0)
+            # A Tweet carries up to four images
+            self.pages = min(max(configuration.get("layout", {}).get("pages", 1), 1), 4)
+
+            pipeline_data = configuration.get("pipeline", {})
+            self.prefetch_workers = pipeline_data.get("prefetchWorkers", 8)
+            self.render_workers = pipeline_data.get("renderWorkers", 1)
+            self.encode_workers = pipeline_data.get("encodeWorkers", 1)
+            self.publish_workers = pipeline_data.get("publishWorkers", 1)
+            self.queue_size = pipeline_data.get("queueSize", 4)
+            self.warm_up = pipeline_data.get("warmUp", True)
+            self.render_deadline = pipeline_data.get("renderDeadline", 60)
+            late_data = pipeline_data.get("lateIcons", {})
+            self.late_placeholder = late_data.get("placeholder", True)
+            self.late_rerender = late_data.get("rerender", True)
+            self.late_replace = late_data.get("replace", [])
+
+            network_data = configuration.get("network", {})
+            self.connect_timeout = network_data.get("connectTimeout", 5)
+            self.read_timeout = network_data.get("readTimeout", 15)
+
+            publishing_data = configuration.get("publishing", {})
+            self.publish_queue = publishing_data.get("queue", "publish-queue.db")
+            self.publish_max_attempts = publishing_data.get("maxAttempts", 5)
+            self.publish_retry_delay = publishing_data.get("retryDelay", 30)
+            # Settings of the enabled destinations other than Twitter
+            self.publishers = {
+                name: publishing_data[name]
+                for name in ("webhook", "filesystem", "s3")
+                if publishing_data.get(name, {}).get("enabled", False)
+            }
+
+            metrics_data = configuration.get("metrics", {})
+            self.metrics_enabled = metrics_data.get("enabled", False)
+            self.metrics_host = metrics_data.get("host", "127.0.0.1")
+            self.metrics_port = metrics_data.get("port", 9464)
+
+            archive_data = configuration.get("archive", {})
+            self.archive_enabled = archive_data.get("enabled", False)
+            self.archive_directory = archive_data.get("directory", "archive")
+            self.archive_retain = archive_data.get("retain", 30)
 
             self.api_key = configuration.get("fortniteAPI", {}).get("apiKey")
             self.support_a_creator = configuration.get("supportACreator")
@@ -47,6 +168,11 @@ class ConfgFile:
             self.twitter_api_secret = twitter_data.get("apiSecret")
             self.twitter_access_token = twitter_data.get("accessToken")
             self.twitter_access_secret = twitter_data.get("accessSecret")
+            self.twitter_chunk_size = twitter_data.get("chunkSize", self.twitter_chunk_size)
+            self.twitter_chunk_retries = twitter_data.get("chunkRetries", self.twitter_chunk_retries)
+            self.twitter_base_url = twitter_data.get("baseUrl")
+            self.twitter_upload_url = twitter_data.get("uploadUrl")
+            self.twitter_timeout = twitter_data.get("timeout", 30)
 
             log.info("Configuration file => Loaded")
             return True
@@ -60,23 +186,35 @@ class APITracker:
     api_key: str = None
     language: str = None
     last_hash: str = None
+    timeout: tuple = (5, 15)
 
-    def __init__(self, api_key: str, language: str = "en") -> None:
+    def __init__(self, api_key: str, language: str = "en", timeout: tuple = (5, 15)) -> None:
         self.api_key = api_key
         self.language = language
+        self.timeout = timeout
 
     def get_itemshop(self) -> dict:
         """
         Return the response of a successful HTTP GET request to the specified
-        URL with the optionally provided header values.
+        URL with the optionally provided header values, None if it failed or timed out.
         """
-        response = requests.get(
-            self.API_URL,
-            headers={"x-api-key": self.api_key},
-            params={"language": self.language}
-        )
+        try:
+            with timed("fetch"):
+                response = requests.get(
+                    self.API_URL,
+                    headers={"x-api-key": self.api_key},
+                    params={"language": self.language},
+                    timeout=self.timeout,
+                )
+        except requests.RequestException as error:
+            polls.inc(status="error")
+            log.error(f"API Tracker => Request failed => {error}")
+            return None
+
+        polls.inc(status=str(response.status_code))
         if response.status_code == 200:
-            return response.json()
+            with timed("decode"):
+                return response.json()
 
         log.error(f"API Tracker => Status code {response.status_code}")
         return None
@@ -101,24 +239,93 @@ class APITracker:
 
 
 class ImageUtility:
-    """Class containing utilitarian image-based functions intended to reduce duplicate code."""
+    """
+    Class containing utilitarian image-based functions intended to reduce duplicate code.
+
+    Pillow is imported by the functions which use it, so checking for updates never loads it.
+    Asset images and fonts are loaded once and shared, they must not be modified.
+    """
+
+    prefetched: dict
+    # Decoded asset images by path and fonts by (path, size), with the modification time they were loaded at
+    images: dict = {}
+    fonts: dict = {}
+
+    def __init__(self, prefetch_workers: int = 8, timeout: tuple = (5, 15)) -> None:
+        self.prefetched = {}
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max(prefetch_workers, 1), thread_name_prefix="prefetch")
+
+    def prefetch(self, urls: list) -> dict:
+        """Start downloading the provided urls in the background, return the futures by url."""
+        for url in urls:
+            if url not in self.prefetched:
+                self.prefetched[url] = self.executor.submit(self.download, url, self.timeout)
+        return {url: self.prefetched[url] for url in urls}
+
+    def fetch(self, url: str, deadline: float = None) -> Image.Image:
+        """
+        Return the image at url, waiting for its prefetch or downloading it now if it was not prefetched.
+
+        Return None if the image is not available by the deadline, a time.time() timestamp.
+        """
+        remaining = None if deadline is None else deadline - time.time()
+        future = self.prefetched.get(url)
+        if future is None:
+            if (remaining is not None) and (remaining <= 0):
+                log.warning(f"ImageUtility.fetch => Render deadline passed => Skipped {url}")
+                return None
+            connect, read = self.timeout
+            return self.download(url, self.timeout if remaining is None else (min(connect, remaining), min(read, remaining)))
 
-    @staticmethod
-    def open(filename: str, directory: str = "assets/images/") -> Image.Image:
-        """Return the specified image file."""
         try:
-            return Image.open(f"{directory}{filename}")
+            return future.result(timeout=None if remaining is None else max(remaining, 0))
+        except FutureTimeoutError:
+            log.warning(f"ImageUtility.fetch => Render deadline passed => Gave up waiting for {url}")
+        return None
+
+    def discard(self, urls: list) -> None:
+        """Forget the prefetched images of the provided urls once they are no longer needed."""
+        for url in urls:
+            self.prefetched.pop(url, None)
+
+    @classmethod
+    def open(cls, filename: str, directory: str = "assets/images/") -> Image.Image:
+        """Return the specified image file, decoded once and then shared."""
+        path = f"{directory}{filename}"
+        cached = cls.images.get(path)
+        if cached is not None:
+            return cached[0]
+        return cls.load_image(path)
+
+    @classmethod
+    def load_image(cls, path: str) -> Image.Image:
+        from PIL import Image
+
+        try:
+            modified = os.path.getmtime(path)
+            image = Image.open(path)
+            # Fully decode now, a lazily decoded image is not safe to share between threads
+            image.load()
         except Exception as error:
             log.error(f"ImageUtility.open => {error}")
-        return None
+            return None
+
+        cls.images[path] = (image, modified)
+        return image
 
     @staticmethod
-    def download(url: str) -> Image.Image:
+    @timed("download")
+    def download(url: str, timeout: tuple = (5, 15)) -> Image.Image:
         """Download and return the raw file from the specified url as an image object."""
+        from io import BytesIO
+        from PIL import Image
+
         try:
-            response = requests.get(url, stream=True)
+            response = requests.get(url, timeout=timeout)
             if response.status_code == 200:
-                return Image.open(response.raw).convert("RGBA")
+                download_bytes.inc(len(response.content))
+                return Image.open(BytesIO(response.content)).convert("RGBA")
             log.error(f"ImageUtility.download => HTTP {response.status_code} => Faild to get {url}")
         except Exception as error:
             log.error(f"ImageUtility.download => {error} => Faild to get {url}")
@@ -127,25 +334,102 @@ class ImageUtility:
     @staticmethod
     def resize(image: Image.Image, max_width: int, max_height: int) -> Image.Image:
         """Resize and return the provided image while maintaining aspect ratio."""
+        from PIL import Image
+
         ratio = max(max_width / image.width, max_height / image.height)
         return image.resize((int(image.width * ratio), int(image.height * ratio)), Image.ANTIALIAS)
 
+    @staticmethod
+    def reduce(image: Image.Image, max_width: int) -> Image.Image:
+        """
+        Downscale and return the provided image to max_width while maintaining aspect ratio,
+        using a fast integer box reduction before the final filtering pass.
+        """
+        from PIL import Image
+
+        if image.width <= max_width:
+            return image
+
+        factor = image.width // max_width
+        if factor >= 2:
+            image = image.reduce(factor)
+        return image.resize((max_width, round(image.height * (max_width / image.width))), Image.LANCZOS)
+
+    @staticmethod
+    def resize_region(image: Image.Image, max_width: int, max_height: int, region: tuple) -> Image.Image:
+        """
+        Return the (left, top, right, bottom) region of the provided image as if it had been
+        resized to cover max_width by max_height and centered, without resizing the rest.
+        """
+        from PIL import Image
+
+        left, top, right, bottom = region
+        ratio = max(max_width / image.width, max_height / image.height)
+        offset = -((max_width - int(image.width * ratio)) // 2)
+        box = (
+            (offset + left) / ratio,
+            top / ratio,
+            min((offset + right) / ratio, image.width),
+            min(bottom / ratio, image.height),
+        )
+        return image.resize((right - left, bottom - top), Image.ANTIALIAS, box=box)
+
     @staticmethod
     def align_center(foreground_width: int, background_width: int, distanceTop: int = 0):
         """Return the tuple necessary for horizontal centering and an optional vertical distance."""
         return ((background_width - foreground_width)//2, distanceTop)
 
-    @staticmethod
-    def font(size: int, font: str = "BurbankBigRegular-Black.ttf", directory: str = "assets/fonts/"):
-        """Return a font object with the specified font file and size."""
+    @classmethod
+    def font(cls, size: int, font: str = "BurbankBigRegular-Black.ttf", directory: str = "assets/fonts/"):
+        """Return a font object with the specified font file and size, loaded once and then shared."""
+        cached = cls.fonts.get((f"{directory}{font}", size))
+        if cached is not None:
+            return cached[0]
+        return cls.load_font(size, font, directory)
+
+    @classmethod
+    def load_font(cls, size: int, font: str = "BurbankBigRegular-Black.ttf", directory: str = "assets/fonts/"):
+        from PIL import ImageFont
+
+        path = f"{directory}{font}"
         try:
-            return ImageFont.truetype(f"{directory}{font}", size)
+            loaded = ImageFont.truetype(path, size)
         except OSError:
             log.warn("ImageUtil => BurbankBigRegular-Black.ttf not found, defaulted font to LuckiestGuy-Regular.ttf")
 
             return ImageFont.truetype(f"{directory}LuckiestGuy-Regular.ttf", size)
         except Exception as error:
             log.error(f"ImageUtil => Failed to load font, {error}")
+            return None
+
+        cls.fonts[(path, size)] = (loaded, os.path.getmtime(path))
+        return loaded
+
+    @classmethod
+    def warm(cls, images: list, fonts: list) -> int:
+        """
+        Load the provided image paths and (size, font, directory) fonts into the caches, reloading
+        any whose file changed since it was loaded. Return the number of files loaded.
+        """
+        loaded = 0
+        for path in images:
+            cached = cls.images.get(path)
+            try:
+                if (cached is not None) and (cached[1] == os.path.getmtime(path)):
+                    continue
+            except OSError:
+                continue
+            loaded += cls.load_image(path) is not None
+
+        for size, font, directory in fonts:
+            cached = cls.fonts.get((f"{directory}{font}", size))
+            try:
+                if (cached is not None) and (cached[1] == os.path.getmtime(f"{directory}{font}")):
+                    continue
+            except OSError:
+                continue
+            loaded += cls.load_font(size, font, directory) is not None
+        return loaded
 
     def fit_text(self, text: str, size: int, max_size: int, font: str = "BurbankBigRegular-Black.ttf"):
         """Return the font and width which fits the provided text within the specified maxiumum width."""
@@ -162,6 +446,18 @@ class ImageUtility:
         return font, text_width, change
 
 
+def write_atomic(filename: str, data: bytes) -> None:
+    """Write data to filename through a temporary file which is atomically renamed over it."""
+    temporary = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary, "wb") as output:
+            output.write(data)
+        os.replace(temporary, filename)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
 def get_date(language: str):
     """Return the provided ISO8601 timestamp in human-readable format."""
     today = date.today()